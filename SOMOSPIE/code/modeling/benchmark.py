@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+# Reproducible benchmark of hyppo.py on synthetic data.
+# Generates train and eval sets, runs hyppo.main on them for every case (a model with its k, D, L, and R),
+#  and writes a JSON report with the wall time of each stage (XtP, NoP, DoN, MiN, and EoN), the peak memory,
+#  the number of neighborhoods modeled per second, and the error against the noiseless surface.
+# The report can be compared against a stored baseline report, to check an algorithm change before rolling it out.
+
+# Commandline example:
+# ./benchmark.py --trainPoints 2000 --evalPoints 20000 -o new.json --baseline baseline.json
+
+import argparse, json, os, platform, random, resource
+import numpy as np
+import scipy
+
+from multiprocessing import get_context
+from time import time
+
+import hyppo
+
+STAGES = ["XtP", "NoP", "DoN", "MiN", "EoN"]
+
+# Each case is MODEL:k:D[:L[:R]], as the -m, -k, -D, -L, and -R arguments of hyppo.py (k is ignored by SBM).
+DEFAULT_CASES = ["KNN:5:0", "HYPPO:20:1", "HYPPO:20:2", "HYPPO:20:2:1", "HYPPO:20:2:0:3", "SBM:0:1"]
+
+
+# Synthetic data in the layout of the model scripts: train rows of x, y, z, c1, ..., cm and eval rows of x, y, c1, ..., cm.
+# The covariates are smooth random waves over the unit square, so that nearby points have similar covariates as in real data.
+# z is a random polynomial of the given degree in the covariates, in which a fraction (density) of the monomials
+#  has a nonzero coefficient, rescaled into [0.1, 0.9], and the training values have normal noise with sd noise.
+# The training points are scattered at random, and the evaluation points lie on a regular grid.
+# Returns the train and eval arrays, and the noiseless z at the evaluation points.
+def make_synthetic(n_train, n_eval, dims=3, degree=2, noise=0.01, density=1.0, seed=0):
+    rng = np.random.default_rng(seed)
+    frequencies = rng.normal(0, 4, (dims, 2))
+    phases = rng.uniform(0, 2*np.pi, dims)
+    num_terms = len(hyppo.monomial_indices(dims, degree))
+    coefficients = rng.normal(0, 1, num_terms)*(rng.uniform(0, 1, num_terms) < density)
+    coefficients[0] = 0
+
+    def covariates(xy):
+        return np.sin(xy @ frequencies.T + phases)
+
+    train_xy = rng.uniform(0, 1, (n_train, 2))
+    side = int(np.ceil(np.sqrt(n_eval)))
+    grid = (np.arange(side) + 0.5)/side
+    eval_xy = np.column_stack([np.repeat(grid, side), np.tile(grid, side)])[:n_eval]
+
+    train_c, eval_c = covariates(train_xy), covariates(eval_xy)
+    train_z = hyppo.design_matrix(train_c, degree) @ coefficients
+    eval_z = hyppo.design_matrix(eval_c, degree) @ coefficients
+    low, high = np.min(train_z), np.max(train_z)
+    spread = high - low if high > low else 1
+    train_z = 0.1 + 0.8*(train_z - low)/spread
+    eval_z = 0.1 + 0.8*(eval_z - low)/spread
+
+    train = np.column_stack([train_xy, train_z + rng.normal(0, noise, n_train), train_c])
+    evaluation = np.column_stack([eval_xy, eval_c])
+    return train, evaluation, eval_z
+
+
+# The hyppo arguments of a case MODEL:k:D[:L[:R]].
+def case_args(case):
+    fields = case.split(":")
+    if not 3 <= len(fields) <= 5 or fields[0] not in ["HYPPO", "KNN", "SBM"]:
+        raise ValueError(f"\"{case}\" is not a valid case; cases are MODEL:k:D[:L[:R]], e.g. HYPPO:20:2:0:3.")
+    model, k, degree, lasso, rand = (fields + ["0", "0"])[:5]
+    return hyppo.model_args(model=model, k=int(k), degree=int(degree), Lasso=float(lasso), randIters=int(rand),
+                            skipVars=2, logFile=os.devnull)
+
+
+# Run one case (repeat times, with the same seeds every time) and return its results.
+# Stage times are the minimum over the repeats; the peak memory is the maximum resident set size of the process,
+#  so every case is run in a fresh process (see run_cases).
+def run_case(case, train, evaluation, truth, repeat=1):
+    seconds = {}
+    for r in range(repeat):
+        random.seed(r)
+        np.random.seed(r)
+        args = case_args(case)
+        profile = {}
+        t0 = time()
+        output = hyppo.main(train, evaluation, args, profile=profile)
+        profile["total"] = time() - t0
+        for stage in STAGES + ["total"]:
+            seconds[stage] = min(seconds.get(stage, np.inf), profile.get(stage, 0))
+
+    # The predictions are grouped by neighborhood, so match them to the evaluation points by their coordinates.
+    by_output = np.lexsort((output[:, 1], output[:, 0]))
+    by_eval = np.lexsort((evaluation[:, 1], evaluation[:, 0]))
+    errors = output[by_output, 2] - truth[by_eval]
+
+    return {"seconds": {stage: round(value, 6) for stage, value in seconds.items()},
+            "peak_memory_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024, 1),
+            "points": int(profile["points"]),
+            "neighborhoods": int(profile["neighborhoods"]),
+            "neighborhoods_per_second": round(profile["neighborhoods"]/seconds["total"], 3),
+            "rmse": round(float(np.sqrt(np.mean(errors**2))), 9)}
+
+
+# Run every case in its own fresh process, so that the peak memory of each is measured separately.
+def run_cases(cases, train, evaluation, truth, repeat=1):
+    results = {}
+    for case in cases:
+        case_args(case)
+        with get_context("spawn").Pool(1) as pool:
+            results[case] = pool.apply(run_case, (case, train, evaluation, truth, repeat))
+        print(f"{case}: {results[case]['seconds']['total']} seconds, {results[case]['neighborhoods_per_second']} neighborhoods per second.")
+    return results
+
+
+# The settings and environment of a benchmark run, to tell whether two reports are comparable.
+def describe_run(args):
+    return {"settings": {"trainPoints": args.trainPoints, "evalPoints": args.evalPoints, "dims": args.dims,
+                         "degree": args.degree, "noise": args.noise, "density": args.density, "seed": args.seed,
+                         "repeat": args.repeat},
+            "environment": {"python": platform.python_version(), "numpy": np.__version__, "scipy": scipy.__version__,
+                            "machine": platform.machine(), "cpus": len(os.sched_getaffinity(0))}}
+
+
+# Print the change of every metric of the cases in both report and baseline,
+#  marking the changes for the worse by more than tolerance (a fraction).
+# Times that change by less than min_seconds are never marked, since the shortest stages are mostly noise.
+# Returns the number of such regressions.
+def compare_reports(report, baseline, tolerance=0.1, min_seconds=0.01):
+    for part in ["settings", "environment"]:
+        if report[part] != baseline[part]:
+            print(f"Warning: the {part} of the baseline differ: {baseline[part]} vs. {report[part]}.")
+
+    # For each metric, whether larger values are worse.
+    metrics = [(f"seconds.{stage}", True) for stage in STAGES + ["total"]] + \
+              [("peak_memory_mb", True), ("neighborhoods_per_second", False), ("rmse", True)]
+    regressions = 0
+    print(f"{'case':<20} {'metric':<26} {'baseline':>14} {'new':>14} {'change':>9}")
+    for case in report["cases"]:
+        if case not in baseline["cases"]:
+            print(f"{case:<20} (not in the baseline)")
+            continue
+        for metric, larger_is_worse in metrics:
+            old, new = baseline["cases"][case], report["cases"][case]
+            for key in metric.split("."):
+                old, new = old[key], new[key]
+            change = (new - old)/old if old else 0.0
+            worse = change > tolerance if larger_is_worse else change < -tolerance
+            if metric.startswith("seconds.") and abs(new - old) < min_seconds:
+                worse = False
+            regressions += worse
+            print(f"{case:<20} {metric:<26} {old:>14.6g} {new:>14.6g} {100*change:>+8.1f}%{'  WORSE' if worse else ''}")
+    return regressions
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description="Benchmark hyppo.py on synthetic data.")
+    parser.add_argument("--trainPoints", type=int, default=2000,
+                        help="The number of training points (default: %(default)s).")
+    parser.add_argument("--evalPoints", type=int, default=20000,
+                        help="The number of evaluation points, on a regular grid (default: %(default)s).")
+    parser.add_argument("--dims", type=int, default=3,
+                        help="The number of covariates (default: %(default)s).")
+    parser.add_argument("--degree", type=int, default=2,
+                        help="The degree of the polynomial of the covariates that makes the dependent variable (default: %(default)s).")
+    parser.add_argument("--density", type=float, default=1.0,
+                        help="The fraction of the monomials of that polynomial with a nonzero coefficient (default: %(default)s).")
+    parser.add_argument("--noise", type=float, default=0.01,
+                        help="The standard deviation of the noise added to the training values (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="The seed of the synthetic data (default: %(default)s).")
+    parser.add_argument("-c", "--case", action="append",
+                        help=f"A case to run, as MODEL:k:D[:L[:R]]; may be given many times (default: {' '.join(DEFAULT_CASES)}).")
+    parser.add_argument("-r", "--repeat", type=int, default=1,
+                        help="The number of times to run each case, keeping the fastest time of each stage (default: %(default)s).")
+    parser.add_argument("-o", "--out", default="benchmark.json",
+                        help="The path for the JSON report (default: %(default)s).")
+    parser.add_argument("-b", "--baseline", default="",
+                        help="The path of a baseline JSON report to compare against; no comparison if empty string (default).")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="The relative change of a metric beyond which it is marked as worse than the baseline (default: %(default)s).")
+    parser.add_argument("--minSeconds", type=float, default=0.01,
+                        help="Changes in time smaller than this many seconds are never marked as worse (default: %(default)s).")
+    return parser
+
+
+if __name__ == "__main__":
+    args = get_parser().parse_args()
+
+    train, evaluation, truth = make_synthetic(args.trainPoints, args.evalPoints, args.dims, args.degree,
+                                              args.noise, args.density, args.seed)
+    report = describe_run(args)
+    report["cases"] = run_cases(args.case or DEFAULT_CASES, train, evaluation, truth, args.repeat)
+
+    with open(args.out, "w") as report_file:
+        json.dump(report, report_file, indent=2, sort_keys=True)
+        report_file.write("\n")
+    print(f"The report has been written to {args.out}.")
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = compare_reports(report, baseline, args.tolerance, args.minSeconds)
+        print(f"{regressions} metrics are worse than the baseline by more than {100*args.tolerance:g}%.")
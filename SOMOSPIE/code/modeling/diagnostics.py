@@ -0,0 +1,86 @@
+# Diagnostics of the local models fit by hyppo.py, gathered in memory and written once at the end of a run.
+# Every fit adds one row with the size of its neighborhood, the chosen degree,
+#  the cross-validation SSE of every degree, the number of nonzero terms of every degree, and the seconds it took.
+# Collectors are plain arrays underneath, so the rows gathered by pool workers or Spark executors
+#  are sent back with their results and merged into the collector of the main process.
+
+import numpy as np
+
+
+class NeighborhoodDiagnostics:
+    def __init__(self, max_degree):
+        self.dtype = np.dtype([("size", np.int32), ("degree", np.int16),
+                               ("sse", np.float64, (max_degree + 1,)), ("terms", np.int32, (max_degree + 1,)),
+                               ("seconds", np.float64)])
+        self.table = np.zeros(64, dtype=self.dtype)
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, extra):
+        if self.count + extra > len(self.table):
+            grown = np.zeros(max(2*len(self.table), self.count + extra), dtype=self.dtype)
+            grown[:self.count] = self.table[:self.count]
+            self.table = grown
+
+    # Add the row of one fit; errors is the SSE of each degree (empty if there was no cross-validation),
+    #  and terms is the count of nonzero terms of each degree up to the chosen one.
+    def record(self, size, degree, errors, terms, seconds):
+        self.reserve(1)
+        row = self.table[self.count]
+        row["size"] = size
+        row["degree"] = degree
+        row["sse"] = np.nan
+        row["sse"][:len(errors)] = errors
+        row["terms"][:len(terms)] = terms
+        row["seconds"] = seconds
+        self.count += 1
+
+    # Add the rows of many fits of degree 0 at once: the means of neighborhoods of the given size
+    #  (one row per mean, in the order of np.ravel(means)), which have no cross-validation errors.
+    def record_means(self, size, means, seconds):
+        means = np.ravel(means)
+        self.reserve(len(means))
+        rows = self.table[self.count:self.count + len(means)]
+        rows["size"] = size
+        rows["degree"] = 0
+        rows["sse"] = np.nan
+        rows["terms"] = 0
+        rows["terms"][:, 0] = means != 0
+        rows["seconds"] = seconds
+        self.count += len(means)
+
+    # Add the rows of another collector (e.g., from a worker), as returned by rows().
+    def extend(self, rows):
+        self.reserve(len(rows))
+        self.table[self.count:self.count + len(rows)] = rows
+        self.count += len(rows)
+
+    def rows(self):
+        return self.table[:self.count]
+
+    # Write the rows as a structured .npy array.
+    def write(self, path):
+        np.save(path, self.rows())
+
+    # Write a line with the SSE of each degree for every fit (the format of hyppo's --errorFile).
+    def write_errors(self, path):
+        with open(path, "w") as error_dump:
+            for sse in self.rows()["sse"]:
+                error_dump.write(",".join(str(err) for err in sse[~np.isnan(sse)]) + "\n")
+
+    # Write a line with the number of nonzero terms of each degree for every fit (the format of hyppo's --degreeCountFile).
+    def write_degree_counts(self, path):
+        rows = self.rows()
+        with open(path, "w") as degreeCount_dump:
+            for degree, terms in zip(rows["degree"], rows["terms"]):
+                degreeCount_dump.write(",".join(str(count) for count in terms[:degree + 1]) + "\n")
+
+    def summary(self):
+        rows = self.rows()
+        if not len(rows):
+            return "No local models were fit."
+        degrees = np.bincount(rows["degree"])
+        return (f"{len(rows)} local models were fit in {rows['seconds'].sum()} seconds; "
+                f"models of each degree: {', '.join(f'{d}: {c}' for d, c in enumerate(degrees))}.")
@@ -4,16 +4,31 @@
 # HYbrid Parallel Piecewise POlynomial.
 
 
-import argparse, csv, random
+import argparse, csv, hashlib, os, random, shutil
+from copy import copy
 import numpy as np
 # https://docs.python.org/3.1/library/itertools.html#itertools.combinations_with_replacement
 from itertools import combinations_with_replacement as cwr 
-from itertools import chain
+from functools import lru_cache
+from itertools import chain, islice
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager, nullcontext
 from time import time
-# https://scikit-learn.org/stable/modules/generated/sklearn.linear_model.Lasso.html
-from sklearn.linear_model import Lasso
+# https://scikit-learn.org/stable/modules/generated/sklearn.linear_model.lars_path.html
+from sklearn.linear_model import lars_path
 from os import cpu_count, sched_getaffinity
-from scipy.special import comb
+# https://docs.python.org/3/library/multiprocessing.shared_memory.html
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+# https://docs.scipy.org/doc/scipy/reference/generated/scipy.linalg.lapack.dpstrf.html
+from scipy.linalg import lapack, solve_triangular
+# https://docs.scipy.org/doc/scipy/reference/generated/scipy.spatial.cKDTree.html
+from scipy.spatial import cKDTree
+from model_cache import LocalModelCache
+from diagnostics import NeighborhoodDiagnostics
+from metrics import Metrics
+from prediction_sink import FORMATS, open_sink
+from numpy.lib.recfunctions import structured_to_unstructured
 
 
 # Function for logging to specified file, or printing if no file given.
@@ -25,6 +40,54 @@ def log(item, file=""):
         print(item)
 
 
+# The Metrics of the current run (or of the current task, in a worker process), or None if they are disabled.
+# Hot paths only pay for a check of this global when metrics are disabled.
+METRICS = None
+
+
+# Count an event in METRICS, if metrics are enabled.
+def count(name, amount=1):
+    if METRICS is not None:
+        METRICS.count(name, amount)
+
+
+# Set METRICS to new Metrics if args.metricsFile is set, or to None otherwise; returns it.
+def reset_metrics(args):
+    global METRICS
+    METRICS = Metrics() if args.metricsFile else None
+    return METRICS
+
+
+# Fresh metrics (or None if they are disabled) for a task of a worker, such as a chunk of neighborhoods in a pool worker
+#  or a partition on a Spark executor, to be sent back with its results; METRICS is restored afterwards.
+@contextmanager
+def task_metrics(args):
+    global METRICS
+    previous = METRICS
+    METRICS = Metrics() if args.metricsFile else None
+    try:
+        yield METRICS
+    finally:
+        METRICS = previous
+
+
+# Merge the metrics sent back by a worker (as from Metrics.as_dict, or None) into METRICS.
+def merge_metrics(worker_metrics):
+    if METRICS is not None and worker_metrics is not None:
+        METRICS.merge(worker_metrics)
+
+
+# Write METRICS, with the stage times of the profile (as filled in by predict_points), to args.metricsFile.
+def write_metrics(profile, args):
+    if METRICS is None:
+        return
+    for stage in ["XtP", "NoP", "DoN", "MiN", "EoN"]:
+        if stage in profile:
+            METRICS.time(stage, profile[stage])
+    METRICS.write(args.metricsFile)
+    log(f"Metrics have been written to {args.metricsFile}.\n", file=args.logFile)
+
+
 # Parallelization initialization.
 def init_parallel():
     print(f"There are {cpu_count()} cores, of which {len(sched_getaffinity(0))} are available.")
@@ -36,27 +99,224 @@ def init_parallel():
     from pyspark import SparkContext as SC
 
 
+# Copy an array into a new block of shared memory.
+# Returns the block (which the caller must close and unlink) and the spec for attach_shared_array.
+def share_array(array):
+    array = np.ascontiguousarray(array)
+    shm = SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+# Attach to a block made by share_array (in another process) and view it as an array without copying.
+def attach_shared_array(spec):
+    name, shape, dtype = spec
+    shm = SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+# Initializer of the process-pool workers: attach the shared training data once per worker.
+def init_worker(indep_spec, dep_spec, args):
+    global WORKER_DATA
+    indep_shm, indep = attach_shared_array(indep_spec)
+    dep_shm, dep = attach_shared_array(dep_spec)
+    # Keep the blocks referenced for as long as the views are in use.
+    WORKER_DATA = (indep_shm, dep_shm, indep, dep, args)
+    # Forked workers would otherwise all draw the same cross-validation partitions.
+    random.seed()
+    np.random.seed()
+
+
+# Fit the models of a chunk of neighborhoods in a worker.
+# Returns the models, the rows of their diagnostics (or None if there are no diagnostics), 
+#  and the metrics of the chunk (or None if metrics are disabled).
+def fit_neighborhoods_in_worker(neighborhoods):
+    _, _, indep, dep, args = WORKER_DATA
+    diagnostics = open_diagnostics(args)
+    with task_metrics(args) as metrics:
+        models = fit_neighborhood_rows(neighborhoods, indep, dep, args, diagnostics)
+    return models, (diagnostics.rows() if diagnostics is not None else None), (metrics.as_dict() if metrics is not None else None)
+
+
+# sweep_neighborhood_rows for a chunk of neighborhoods in a worker, for the k and degrees of a parameter sweep.
+# Returns the models and the metrics of the chunk (or None if metrics are disabled).
+def sweep_neighborhoods_in_worker(task):
+    neighborhoods, k, degrees = task
+    _, _, indep, dep, args = WORKER_DATA
+    args = copy(args)
+    args.k = k
+    with task_metrics(args) as metrics:
+        models = sweep_neighborhood_rows(neighborhoods, indep, dep, args, degrees)
+    return models, (metrics.as_dict() if metrics is not None else None)
+
+
+# The number of worker processes: args.workers, or all available cores if 0.
+def pool_size(args):
+    return args.workers if args.workers > 0 else len(sched_getaffinity(0))
+
+
+# A local pool of args.workers processes (all available cores if 0) for fitting local models.
+# The training data is placed in shared memory once, rather than being copied to every task,
+#  and the shared memory is released when the pool is closed.
+# With args.float32, the independent variables are shared in single precision, which halves that block;
+#  the workers convert the rows of each neighborhood back to double precision to fit its model.
+@contextmanager
+def worker_pool(indep_data, dep_data, args):
+    indep_shm, indep_spec = share_array(indep_data.astype(np.float32) if args.float32 else indep_data)
+    dep_shm, dep_spec = share_array(dep_data)
+    try:
+        with Pool(pool_size(args), initializer=init_worker, initargs=(indep_spec, dep_spec, args)) as pool:
+            yield pool
+    finally:
+        for shm in (indep_shm, dep_shm):
+            shm.close()
+            shm.unlink()
+
+
+# Split neighborhoods (an array with one row of training indices each) into batches of up to args.fitBatch, 
+#  whose models of up to degree are cross-validated and fit together, 
+#  or return None if they are to be fit one at a time instead.
+# Random term selection (-R without -L) draws from the same random stream as the cross-validation partitions,
+#  so those neighborhoods are fit one at a time, which keeps the draws (and the results) the same.
+def neighborhood_batches(neighborhoods, indep, dep, degree, args):
+    if args.fitBatch <= 0 or args.model == "KNN" or (args.randIters and not args.Lasso) or np.ndim(neighborhoods) != 2:
+        return None
+    
+    # Bound the stacked systems of a batch (a Gram matrix and right-hand sides for every fold) to about 2**22 numbers.
+    n, dim = neighborhoods.shape[1], indep.shape[1]
+    T = num_terms(dim, degree, basis_of(args))
+    per_neighborhood = args.k*T*(T + np.size(dep[0])) + n*T
+    batch_size = max(1, min(args.fitBatch, 2**22//per_neighborhood))
+    return [neighborhoods[start:start + batch_size] for start in range(0, len(neighborhoods), batch_size)]
+
+
+# Fit the models of neighborhoods (an array with one row of training indices each) in this process: 
+#  in batches with models_in_neighborhoods, where it applies (see neighborhood_batches), 
+#  or one at a time with model_in_neighborhood otherwise.
+def fit_neighborhood_rows(neighborhoods, indep, dep, args, diagnostics=None):
+    batches = neighborhood_batches(neighborhoods, indep, dep, args.degree, args)
+    if batches is None:
+        return [model_in_neighborhood(indep[N], dep[N], args, diagnostics) for N in neighborhoods]
+    return [model for batch in batches for model in models_in_neighborhoods(batch, indep, dep, args, diagnostics)]
+
+
+# Fit the models of all the neighborhoods (an array with one row of training indices each) with a worker_pool.
+# Returns the [degree, coefficients] of every neighborhood, in order, and adds the workers' rows to diagnostics.
+def fit_neighborhoods_in_pool(neighborhoods, pool, args, diagnostics=None):
+    # Several chunks per worker, so that a worker with slow neighborhoods doesn't hold up the rest.
+    chunks = [chunk for chunk in np.array_split(neighborhoods, 4*pool_size(args)) if len(chunk)]
+    log(f"Fitting {len(neighborhoods)} neighborhoods in {len(chunks)} chunks with {pool_size(args)} worker processes.\n", file=args.logFile)
+    fitted = pool.map(fit_neighborhoods_in_worker, chunks, chunksize=1)
+    for models, rows, metrics in fitted:
+        if diagnostics is not None:
+            diagnostics.extend(rows)
+        merge_metrics(metrics)
+    return [model for models, rows, metrics in fitted for model in models]
+
+
+# The basis of the local polynomials, for high dimensional data, where the number of monomials of the full basis
+#  grows combinatorially with the number of covariates:
+#  interactions is the most covariates that one term may combine (e.g., 1 for the powers of each covariate alone,
+#  or 2 for pairwise interactions), and cross_degree is the highest degree of a term that combines several covariates
+#  (e.g., 2 for the powers of each covariate up to the degree, plus the products of pairs of covariates).
+# 0 is no limit for either, so Basis() is the full basis.
+Basis = namedtuple("Basis", ["interactions", "cross_degree"], defaults=[0, 0])
+
+
+# The Basis given by args.interactions and args.crossDegree.
+def basis_of(args):
+    return Basis(args.interactions, args.crossDegree)
+
+
+# Given the polynomial dimension n and degree d, this returns the table of monomial terms
+#  in the same order as cwr(chain([1.0], point), d), as an int array of shape (terms, d).
+# Row t lists the indices into the augmented point [1.0, x_1, ..., x_n] whose product is term t,
+#  so index 0 stands for the constant factor; for d=0 there is the single empty product.
+# With a limited Basis, the terms outside of it are left out.
+# Because cwr is lexicographic, the degree-(d-1) terms are a prefix of the degree-d terms (in any Basis),
+#  and the terms are in order of their degree.
+# Tables are cached, so each (n, d, basis) is only ever enumerated once per process.
+@lru_cache(maxsize=None)
+def monomial_indices(n, degree, basis=Basis()):
+    terms = list(cwr(range(n + 1), degree))
+    if basis.interactions or basis.cross_degree:
+        def in_basis(term):
+            covariates = len(set(term) - {0})
+            order = np.count_nonzero(term)
+            return ((not basis.interactions or covariates <= basis.interactions) and 
+                    (not basis.cross_degree or covariates < 2 or order <= basis.cross_degree))
+        terms = [term for term in terms if in_basis(term)]
+    table = np.array(terms, dtype=np.intp).reshape(len(terms), degree)
+    table.setflags(write=False)
+    return table
+
+
+# The number of terms of the polynomials of dimension n and degree d in the basis.
+def num_terms(n, degree, basis=Basis()):
+    return len(monomial_indices(n, degree, basis))
+
+
+# This function expects:
+# * points, an array-like of shape (m, n) (or a list of m points of dimension n).
+# * the degree of the polynomial (integer).
+# * the Basis of the polynomial (the full basis by default).
+# This function returns the (m, terms) design matrix, one row of monomials per point,
+#  with the columns in the order of monomial_indices(n, degree, basis).
+def design_matrix(points, degree, basis=Basis()):
+    points = np.asarray(points, dtype=float)
+    if points.ndim == 1:
+        points = points.reshape(1, -1)
+    m, n = points.shape
+    if not degree:
+        return np.ones((m, 1))
+    table = monomial_indices(n, degree, basis)
+
+    augmented = np.empty((m, n + 1))
+    augmented[:, 0] = 1.0
+    augmented[:, 1:] = points
+    # Multiply one factor of every term at a time, so memory stays at a single (m, terms) block.
+    A = augmented[:, table[:, 0]]
+    for j in range(1, degree):
+        A *= augmented[:, table[:, j]]
+    return A
+
+
+# This function expects:
+# * a list of coefficients for the polynomial in the order of monomial_indices.
+# * the degree of the polynomial (integer).
+# * points, an array-like of shape (m, n) of where to evaluate the polynomial.
+# * the Basis of the polynomial (the full basis by default).
+# This function returns the length-m array of values of the polynomial at the points provided.
+def evaluate_polynomial_batch(coefficients, degree, points, basis=Basis()):
+    points = np.asarray(points, dtype=float)
+    if not degree:
+        return np.full(len(points), coefficients[0], dtype=float)
+    return design_matrix(points, degree, basis).dot(np.asarray(coefficients, dtype=float))
+
+
 # This function expects:
 # * a list of coefficients for the polynomial in order: 
 # * the degree of the polynomial (integer).
 # * a point (list of floats) of where to evaluate the polynomial.
+# * the Basis of the polynomial (the full basis by default).
 # This function returns the value of the polynomial evaluated at the point provided.
-def evaluate_polynomial(coefficients, degree, point):
+def evaluate_polynomial(coefficients, degree, point, basis=Basis()):
     if degree == 0:
         return coefficients[0]
     
-    monomials = [ np.product(x) for x in cwr(chain([1.0], point), degree) ]
-    return sum( [ a[0]*a[1] for a in zip(coefficients, monomials) ] )
+    return evaluate_polynomial_batch(coefficients, degree, [point], basis)[0]
 
 
-# Given a list coefs of coefficients, and polynomial dimension n and degree d, 
+# Given a list coefs of coefficients, and polynomial dimension n, degree d, and Basis, 
 # This returns the number of non-zero monomials of each degree up to d.
-def degree_counts(coefs, n, d):
+def degree_counts(coefs, n, d, basis=Basis()):
     i = 0
     tallies = []
+    # The number of terms of each degree; the terms are in order of their degree.
+    sizes = np.bincount(np.count_nonzero(monomial_indices(n, d, basis), axis=1), minlength=d + 1)
     for deg in range(d + 1):
         #print(len(coefs), n, d, i, deg)
-        terms = comb(n, deg, exact=True, repetition=True)
+        terms = int(sizes[deg])
         # Quick check to make sure coefs is still as long as it needs to be for given n and d
         if (i + terms) > len(coefs):
             print(coefs, n, d, tallies, i, terms)
@@ -67,57 +327,143 @@ def degree_counts(coefs, n, d):
     return tallies
 
 
-# This function uses the Lasso method with a dynamically modified penalty
-#  to find which monomials should be used for polynomial construction.
+# This function uses the Lasso method to find which monomials should be used for polynomial construction.
 # The target number of monomials is from bottom to top. 
-def determine_terms(A, Z, bottom, top, init_alpha=1.0, min_alpha=2**(-9), try_lstsq=False, max_iter=2**12):
+# Instead of searching for a penalty alpha that gives a suitable number of terms, 
+#  this follows the whole Lasso regularization path with LARS, which adds (or drops) one term per iteration,
+#  and picks the point on the path with as many terms as possible, but no more than top.
+# This returns a 0/1 list indicating which columns to use, and the number of LARS iterations it took.
+def determine_terms(A, Z, bottom, top, max_iter=2**12):
     if (bottom > top):
-        raise ValueError(f"Error! low must be less than or equal to high, but you gave {low} and {high}.")
-    low, high = bottom, top
+        raise ValueError(f"Error! bottom must be less than or equal to top, but you gave {bottom} and {top}.")
     
-    if try_lstsq:
-        # First solve the system with least squares to see if we even need Lasso method.
-        coef = np.linalg.lstsq(A, Z)[0]
-        alpha = 2*init_alpha
-    else:
-        alpha = init_alpha
-        Lassy = Lasso(alpha)
-        coef = Lassy.fit(A, Z).coef_
+    # Lasso fits an intercept, so it works with centered columns; the constant column then never enters the path.
+    A = np.asarray(A, dtype=float)
+    A = A - np.mean(A, axis=0)
+    Z = np.asarray(Z, dtype=float)
+    Z = Z - np.mean(Z)
     
-    nonzeros = np.count_nonzero(coef)
-        
-    # The value of alpha is used by Lasso to penalize non-zero monomials
-    # so, higher alpha corresponds to fewer terms.
-    while (nonzeros < low) or (nonzeros > high):
-        # If there are too few nonzero terms, cut the penalty alpha in half...
-        alpha /= 2
-        # ... but if there are too many, multiply the penatly by 3/2.
-        if nonzeros > high:
-            alpha *= 3
-        # Use of 1/2 and 3/2 prevents repeated values of alpha.
-            
-        # If the penalty has gotten too small, something is wrong.
-        if alpha < min_alpha:
-            # If possible, decriment low for a larger range of target values...
-            if low > 1:
-                low -= 1
-                alpha = init_alpha
-            # ... otherwise, terminate the process and just use degree 0.
-            else:
-                coef = [np.mean(Z)]
-                nonzeros = 1
-                print("Alpha too small. Using degree=0.")
-                break
+    # https://scikit-learn.org/stable/modules/generated/sklearn.linear_model.lars_path.html
+    # Column j of path holds the coefficients at the j-th breakpoint of the path, from most to least penalized.
+    alphas, active, path, iterations = lars_path(A, Z, method="lasso", max_iter=max_iter, return_n_iter=True)
+    count("lasso.calls")
+    count("lasso.iterations", iterations)
+    nonzeros = np.count_nonzero(path, axis=0)
+    
+    # If the path never gets up to bottom terms (e.g., the columns span too small a space), 
+    #  settle for the most terms it does reach.
+    allowed = np.flatnonzero(nonzeros <= top)
+    step = allowed[np.argmax(nonzeros[allowed])]
+    if not nonzeros[step]:
+        # There is nothing to select, so just use the constant term (degree=0).
+        print("No terms selected by Lasso. Using degree=0.")
+        terms = [False]*A.shape[1]
+        terms[0] = True
+        return terms, iterations
+    
+    #print(f"With alpha={alphas[step]}, we have selected {nonzeros[step]} terms, where {bottom}<={nonzeros[step]}<={top}.")
+    return [bool(c) for c in path[:, step]], iterations
+
+
+# Solve the normal equations AtA x = AtZ, given AtA (symmetric positive semi-definite) and AtZ,
+#  with a single pivoted Cholesky factorization of AtA.
+# The rank revealed by that factorization also tells us if the system is rank deficient,
+#  in which case this returns None instead of a solution.
+def solve_normal_equations(AtA, AtZ):
+    U, piv, rank, info = lapack.dpstrf(AtA)
+    if rank < len(AtA):
+        return None
+    # The factorization is AtA[p][:, p] = U^T U, with U upper triangular.
+    p = piv - 1
+    y = solve_triangular(U, AtZ[p], trans='T')
+    coef = np.empty_like(y)
+    coef[p] = solve_triangular(U, y)
+    return coef
+
+
+# Solve the least-squares problem A x ~= Z with a single column-pivoted QR factorization of A (LAPACK's dgeqp3),
+#  which avoids squaring the condition number of A as the normal equations do.
+# With pivoting, the magnitudes on the diagonal of R are non-increasing and reveal the rank of A;
+#  if A is rank deficient (by the tolerance of np.linalg.matrix_rank, with |R[0, 0]| for the largest singular value),
+#  this returns None instead of a solution.
+# Z may be 2-D, with one right-hand side per column, which all share the factorization.
+def solve_least_squares(A, Z):
+    m, n = A.shape
+    if m < n:
+        return None
+    QR, jpvt, tau, work, info = lapack.dgeqp3(A)
+    R = np.triu(QR[:n])
+    diagonal = np.abs(np.diag(R))
+    if diagonal[-1] <= diagonal[0]*max(m, n)*np.finfo(float).eps:
+        return None
+    # Apply Q^T to Z with the Householder reflectors of the factorization, without forming Q.
+    C = Z.reshape(m, -1)
+    QtZ, work, info = lapack.dormqr("L", "T", QR, tau, C, lwork=64*max(n, C.shape[1]))
+    coef = np.empty((n,) + Z.shape[1:])
+    coef[jpvt - 1] = solve_triangular(R, QtZ[:n].reshape(coef.shape))
+    return coef
+
+
+# solve_normal_equations for a stack of systems at once: AtA is an (S, T, T) stack of symmetric positive semi-definite matrices,
+#  and AtZ is the (S, T) stack of right-hand sides (or (S, T, R), with R right-hand sides per system).
+# The pivoted Cholesky factorization runs one column at a time over the whole stack, each system choosing its own pivots,
+#  and a system is rank deficient when its largest remaining pivot falls to the tolerance that LAPACK's dpstrf uses.
+# Returns the stack of solutions (NaN for the rank-deficient systems) and the boolean mask of the full-rank systems.
+def batch_solve_normal_equations(AtA, AtZ):
+    S, T = AtA.shape[:2]
+    L = np.array(AtA, dtype=float)
+    Y = np.array(AtZ, dtype=float)
+    Y = Y.reshape(S, T, int(np.prod(Y.shape[2:])))
+    perm = np.tile(np.arange(T), (S, 1))
+    systems = np.arange(S)
+    full_rank = np.ones(S, dtype=bool)
+    
+    diagonal = np.arange(T)
+    for j in range(T):
+        # Swap the largest remaining pivot of every system into place.
+        piv = j + np.argmax(L[:, diagonal[j:], diagonal[j:]], axis=1)
+        L[systems, j], L[systems, piv] = L[systems, piv], L[systems, j]
+        L[systems, :, j], L[systems, :, piv] = L[systems, :, piv], L[systems, :, j]
+        perm[systems, j], perm[systems, piv] = perm[systems, piv], perm[systems, j]
         
-        # Use lasso with the current alpha to solve the system
-        Lassy = Lasso(alpha, max_iter=max_iter)
-        coef = Lassy.fit(A, Z).coef_
-        nonzeros = np.count_nonzero(coef)
-        #print(f"low={low} ; nonzeros={nonzeros} ; high={high} ; alpha={alpha}")
+        ajj = L[:, j, j]
+        if not j:
+            # dpstrf's default tolerance: T times the unit roundoff times the largest diagonal entry.
+            tolerance = T*np.finfo(float).eps/2*ajj
+        stop = (ajj <= tolerance) | np.isnan(ajj)
+        full_rank &= ~stop
+        ajj = np.sqrt(np.where(stop, 1.0, ajj))
+        L[:, j, j] = ajj
+        L[:, j + 1:, j] /= ajj[:, None]
+        L[:, j + 1:, j + 1:] -= L[:, j + 1:, j, None]*L[:, None, j + 1:, j]
     
-    #print(f"With alpha={alpha}, we have selected {nonzeros} terms, where {low}<={nonzeros}<={high}.")
-    #print(f"The largest |coefficient| is {max([abs(c) for c in coef if c])}")
-    return [bool(c) for c in coef]
+    # Forward and back substitution with the factorization AtA[p][:, p] = L L^T.
+    Y = Y[systems[:, None], perm]
+    for j in range(T):
+        Y[:, j] = (Y[:, j] - np.einsum('si,sir->sr', L[:, j, :j], Y[:, :j]))/L[:, j, j, None]
+    for j in reversed(range(T)):
+        Y[:, j] = (Y[:, j] - np.einsum('si,sir->sr', L[:, j + 1:, j], Y[:, j + 1:]))/L[:, j, j, None]
+    coef = np.empty_like(Y)
+    coef[systems[:, None], perm] = Y
+    coef[~full_rank] = np.nan
+    return coef.reshape(np.shape(AtZ)), full_rank
+
+
+# solve_least_squares for a stack of systems at once: A is an (S, m, n) stack of matrices,
+#  and Z is the (S, m) stack of right-hand sides (or (S, m, R), with R right-hand sides per system).
+# The systems are solved from one stacked SVD, which also reveals their rank (with the tolerance of np.linalg.matrix_rank).
+# Returns the stack of solutions (NaN for the rank-deficient systems) and the boolean mask of the full-rank systems.
+def batch_solve_least_squares(A, Z):
+    S, m, n = A.shape
+    if m < n:
+        return np.full((S, n) + np.shape(Z)[2:], np.nan), np.zeros(S, dtype=bool)
+    U, singular, Vt = np.linalg.svd(A, full_matrices=False)
+    full_rank = singular[:, -1] > singular[:, 0]*m*np.finfo(float).eps
+    singular[~full_rank] = 1.0
+    weights = np.einsum('sji,sjr->sir', U, np.reshape(Z, (S, m, -1)))/singular[:, :, None]
+    coef = np.einsum('sji,sjr->sir', Vt, weights)
+    coef[~full_rank] = np.nan
+    return coef.reshape((S, n) + np.shape(Z)[2:]), full_rank
 
 
 # independent_variable_points is a list of settings for the independent variables that were observed.
@@ -125,119 +471,176 @@ def determine_terms(A, Z, bottom, top, init_alpha=1.0, min_alpha=2**(-9), try_ls
 # It is important that for each i the result of independent_variable_points[i] is stored as dependent_variable_values[i].
 # degree is the degree of the polynomial to build.
 # rand is nonnegative if using a seed to randomly select terms.
+# basis is the Basis of the polynomial (the full basis by default).
 # This function returns the list of coefficients of the best fit polynomial surface of degree "degree".
-def determine_coefficients(independent_variable_points, dependent_variable_values, degree, lasso=0, rand=0):
+def determine_coefficients(independent_variable_points, dependent_variable_values, degree, lasso=0, rand=0, basis=Basis()):
     
-    # If degree==0, cwr returns [()], then np.product[()] is 1.0.
-    #print(degree, list(cwr(chain([1.0], independent_variable_points[0]), degree)))
-    A = [ [np.product(x) for x in cwr(chain([1.0], iv), degree)] for iv in independent_variable_points ]
-    Z = np.array(dependent_variable_values)
+    # If degree==0, the design matrix is a single column of 1.0's.
+    A = design_matrix(independent_variable_points, degree, basis)
+    return coefficients_from_design(A, dependent_variable_values, degree, lasso, rand)
+
+
+# determine_coefficients for several dependent variables, the columns of dependent_variable_values,
+#  given the degree (and the rand state from cross-validation) of each.
+# The targets of the same degree share the design matrix, and if it has full column rank (or the degree is zero),
+#  they are solved together as multiple right-hand sides of one factorization;
+#  otherwise each of them falls back to coefficients_from_design on its own.
+# Returns the list of coefficients of each target.
+def determine_target_coefficients(independent_variable_points, dependent_variable_values, degrees, lasso=0, rand_states=None, 
+                                  basis=Basis()):
+    Z = np.asarray(dependent_variable_values, dtype=float)
+    degrees = np.asarray(degrees)
+    coefficients = [None]*len(degrees)
+    for degree in np.unique(degrees):
+        targets = np.flatnonzero(degrees == degree)
+        A = design_matrix(independent_variable_points, degree, basis)
+        if not degree:
+            count("solver.mean", len(targets))
+            coef = np.mean(Z[:, targets], axis=0, keepdims=True)
+        else:
+            coef = solve_least_squares(A, Z[:, targets])
+            if coef is not None:
+                count("solver.solve", len(targets))
+        for j, target in enumerate(targets):
+            if coef is not None:
+                coefficients[target] = list(coef[:, j])
+            else:
+                rand = rand_states[target] if rand_states is not None else 0
+                coefficients[target] = coefficients_from_design(A, Z[:, target], degree, lasso, rand)
+    return coefficients
+
+
+# The same as determine_coefficients, but given the design matrix A = design_matrix(independent_variable_points, degree).
+# Full-rank systems are solved with a single pivoted QR factorization of A (see solve_least_squares),
+#  which also tells when the system is rank deficient and terms have to be selected.
+def coefficients_from_design(A, dependent_variable_values, degree, lasso=0, rand=0):
+    A = np.asarray(A, dtype=float)
+    Z = np.asarray(dependent_variable_values, dtype=float)
     Zbar = np.mean(Z)
-            
-    # https://docs.scipy.org/doc/numpy/reference/generated/numpy.linalg.solve.html
-    # We need matrix A to be square to solve AX=Z for vector X with np.linalg.solve
-    # So multiply both sides on the left by the transpose of A. 
-    At = np.transpose(A)
-    AtA = np.dot(At, A)
-    
-    #if degree:
-        #print(f"\nAt.shape: {At.shape}\nnp.linalg.matrix_rank(At): {np.linalg.matrix_rank(At)}")#\nA: {A}")
-        #print(f"degree: {degree}\nlen(Z): {len(Z)}\nnp.mean(Z): {np.mean(Z)}\nZ: {Z}")
-        #print(f"AtA.shape: {AtA.shape}\nnp.linalg.det(AtA): {np.linalg.det(AtA)}")
     
     # If the polynomial is degree zero, just the the average.
     if not degree:
-        coef = [Zbar]
+        count("solver.mean")
+        return [Zbar]
+    
+    # Otherwise, if A has full column rank, we can solve the system with the least-squares method.
+    coef = solve_least_squares(A, Z)
+    if coef is not None:
+        count("solver.solve")
+        return list(coef)
         
-    # Otherwise, if the determinant of A.transpose() * A is non-zero, 
-    #  we can solve the system with the least-squares method
-    #elif abs(np.linalg.det(AtA))>2**(-20):
-    elif np.linalg.matrix_rank(At) >= At.shape[0]:
-        #print(f"AtA has determinent {np.linalg.det(AtA)}")
-        coef = np.linalg.solve(AtA, np.dot(At, Z))
-        #print(f"solve'd coef: {coef}")
+    # If the system is under-determined, 
+    #  we need something like Lasso to reduce the number of terms, ...
+    if lasso>0:
+        count("solver.lasso")
         
-    else:
-        #print(f"lasso={lasso} ; len(A)={len(A)} ; len(Z)={len(Z)} ; degree={degree}")
-            
-        # If the system is under-determined, 
-        #  we need something like Lasso to reduce the number of terms, ...
-        if lasso>0:
-            
-            # Shift the dep. var. values to be 0-mean.
-            # This is because Lasso seems to be biased toward higher degree terms.
-            Z = Z - Zbar
-            
-            # This creates a 0/1 array indicating which columns to use.
-            coef = determine_terms(A, Z, len(Z) - 1, len(Z) - 1)
-            #print(f"The number of terms of each degree are: {degree_counts(coefs, len(independent_variable_points[0]), degree)}")
-            
-            # Cut down A to only the terms/columns selected by Lasso
-            A = [[a for a,i in zip(row,coef) if i] for row in A]
-            
-            # Apply the lstsq solving method to what's left, now that there aren't too many columns
-            At = np.transpose(A)
-            AtA = np.dot(At, A)
-            neoef = np.linalg.solve(AtA, np.dot(At,Z))
-            
-            # Determine the indices of the selected terms...
-            nzs = [i for i in range(len(coef)) if coef[i]]
-            # ... and use those indices to put the solved coefficients in the right place.
-            for i,c in zip(nzs, neoef):
-                coef[i] = c
-            
-            # Couteract the earlier shift of the dep. var. values.
-            coef[0] += Zbar
-            
-            #print(f"lasso'd coef: {coef}")
-            
-        # ... or random term selection...
-        elif rand:
-            num_possible_terms = len(A[0])
-                        
-            if type(rand) == int:
-                # ToDo: make sure the randomizer is big enough.
-                coef_indices = sorted(random.sample(range(1,num_possible_terms), len(Z) - 1))
-                coef_indices.insert(0,0)
-                coef = [(index in coef_indices) for index in range(num_possible_terms)]
-            
-            ################################
-            else:
-                # Sum up the coefficients from cross-validation polynomials that minimized SSE.
-                coef = sum([np.array(coefs) for coefs in rand.values()])
-                # Determine the max number of coefficients allowed.
-                cutoff = min(len(Z), len(coef)) - 1
-                # Determine what absolute value a coefficient needs to land in the top.
-                threshold = abs(sorted(coef, key=lambda x: abs(x), reverse=True)[cutoff])
-                # Trim down to the coefficients that are above the threshold, if there are too many.
-                if threshold>0:
-                    coef = [(abs(c) >= threshold) for c in coef]
-                coef_indices = [i for i,c in enumerate(coef) if c]
-                                
-                #print(f"degree: {degree}; cutoff: {cutoff}; threshold: {threshold}\ncoef: {coef}")
-    
-            # Cut down A to only the terms/columns selected randomly
-            A = [[a for a,c in zip(row,coef) if c] for row in A]
-            
-            # Apply the lstsq solving method to what's left, now that there aren't too many columns
-            At = np.transpose(A)
-            AtA = np.dot(At, A)
-            neoef = np.linalg.solve(AtA, np.dot(At,Z))
-            
-            # Use the selected indices to put the solved coefficients in the right place.
-            for i,c in zip(coef_indices, neoef):
-                coef[i] = c
+        # Shift the dep. var. values to be 0-mean.
+        # This is because Lasso seems to be biased toward higher degree terms.
+        Z = Z - Zbar
         
-        # ... or dangerous and naive use of lstsq's built-in handling of underdetermined systems.
-        else:
-            # https://docs.scipy.org/doc/numpy/reference/generated/numpy.linalg.lstsq.html
-            coef = np.linalg.lstsq(A, Z, rcond=-1)[0]#, rcond=None)[0]
+        # This creates a 0/1 array indicating which columns to use.
+        terms, lasso_iterations = determine_terms(A, Z, len(Z) - 1, len(Z) - 1)
+        terms = np.array(terms, dtype=bool)
+        
+        # Solve for the terms/columns selected by Lasso, now that there aren't too many columns, 
+        #  and put the solved coefficients in the right place.
+        coef = np.zeros(A.shape[1])
+        coef[terms] = solve_selected_terms(A[:, terms], Z)
+        
+        # Couteract the earlier shift of the dep. var. values.
+        coef[0] += Zbar
         
-            #print(f"lstsq'd coef: {coef}")
+    # ... or random term selection...
+    elif rand:
+        count("solver.random")
+        num_possible_terms = A.shape[1]
+                    
+        if type(rand) == int:
+            # ToDo: make sure the randomizer is big enough.
+            coef_indices = sorted(random.sample(range(1,num_possible_terms), len(Z) - 1))
+            coef_indices.insert(0,0)
+            terms = np.zeros(num_possible_terms, dtype=bool)
+            terms[coef_indices] = True
+        
+        ################################
+        else:
+            # Sum up the coefficients from cross-validation polynomials that minimized SSE.
+            coef = sum([np.array(coefs) for coefs in rand.values()])
+            # Determine the max number of coefficients allowed.
+            cutoff = min(len(Z), len(coef)) - 1
+            # Determine what absolute value a coefficient needs to land in the top.
+            threshold = np.sort(np.abs(coef))[::-1][cutoff]
+            # Trim down to the coefficients that are above the threshold, if there are too many.
+            terms = np.abs(coef) >= threshold if threshold>0 else coef != 0
+                            
+        # Solve for the terms/columns selected randomly, and put the solved coefficients in the right place.
+        coef = np.zeros(num_possible_terms)
+        coef[terms] = solve_selected_terms(A[:, terms], Z)
+    
+    # ... or dangerous and naive use of lstsq's built-in handling of underdetermined systems.
+    else:
+        # https://docs.scipy.org/doc/numpy/reference/generated/numpy.linalg.lstsq.html
+        count("solver.lstsq")
+        coef = np.linalg.lstsq(A, Z, rcond=-1)[0]#, rcond=None)[0]
     
     return list( coef )
 
 
+# Solve for the coefficients of the columns (A) selected by Lasso or at random.
+# If even those are rank deficient, fall back to the minimum-norm least-squares solution.
+def solve_selected_terms(A, Z):
+    coef = solve_least_squares(A, Z)
+    if coef is None:
+        count("solver.selected_lstsq")
+        coef = np.linalg.lstsq(A, Z, rcond=None)[0]
+    return coef
+
+
+# Random term selection for cross-validation, done in a batch instead of one attempt at a time.
+# Draws attempts random sets of terms (the constant and len(Z) - 1 others, as coefficients_from_design does),
+#  solves all of them at once from one stacked SVD of the selected columns of the design matrix A,
+#  and scores all of them at once on the testing rows (testing_A, testing_Z).
+# Systems that are still rank deficient get the minimum-norm solution, as in solve_selected_terms.
+# The attempts are split into batches of at most max_elements numbers in the stacked matrices.
+# Returns the SSE of the best attempt on the testing rows, its coefficients, and the coefficients of the last attempt
+#  (zero for the terms not selected).
+# Raises ValueError if no attempt gives a finite SSE.
+def best_random_terms(A, Z, testing_A, testing_Z, attempts, max_elements=2**22):
+    n, num_possible_terms = A.shape
+    # Raises ValueError if there are more rows than terms to choose from, like coefficients_from_design.
+    subsets = np.array([[0] + sorted(random.sample(range(1, num_possible_terms), n - 1)) for _ in range(attempts)])
+    count("solver.random", attempts)
+
+    best_SSE, best, last = np.inf, None, None
+    batch_size = max(1, max_elements//(n*n))
+    for start in range(0, attempts, batch_size):
+        batch = subsets[start:start + batch_size]
+        # Every attempt's square system, stacked as (attempt, row, term).
+        U, S, Vt = np.linalg.svd(np.moveaxis(A[:, batch], 1, 0))
+        tolerance = S[:, :1]*n*np.finfo(float).eps
+        weights = np.divide(np.einsum('aji,j->ai', U, Z), S, out=np.zeros_like(S), where=S > tolerance)
+        coefs = np.einsum('aji,aj->ai', Vt, weights)
+
+        residuals = np.einsum('tai,ai->at', testing_A[:, batch], coefs) - testing_Z
+        SSEs = np.einsum('at,at->a', residuals, residuals)
+        a = np.argmin(np.where(np.isnan(SSEs), np.inf, SSEs))
+        if SSEs[a] < best_SSE:
+            best_SSE = SSEs[a]
+            best = np.zeros(num_possible_terms)
+            best[batch[a]] = coefs[a]
+        last = np.zeros(num_possible_terms)
+        last[batch[-1]] = coefs[-1]
+    if best is None:
+        raise ValueError("None of the random sets of terms gave a finite SSE.")
+    return best_SSE, best, last
+
+
+# The l_N distances (before taking the N-th root, which does not change the ranking) 
+#  from every row of data_points to specific_point.
+def lN_distances(data_points, specific_point, norm=2):
+    return np.sum(np.abs(np.asarray(data_points) - specific_point)**norm, axis=-1)
+
+
 # data_points is a list of the observed independent variable settings.
 # specific_points is one chosen setting of the independent variables.
 # k is the number of nearest neighbors to find.
@@ -257,11 +660,247 @@ def indices_of_NNs(data_points, specific_point, k, norm=2):
     if (k >= len(data_points)):
         return range(len(data_points))
     
-    distances = [ sum( (x - specific_point)**norm ) for x in data_points ]
+    distances = lN_distances(data_points, specific_point, norm)
     indices = np.argsort( distances, kind='mergesort' )[:k]
     return indices
 
 
+# Build the spatial index (a k-d tree) over the observed independent variable settings.
+# This only needs to be done once; every neighbor query is then answered by batch_indices_of_NNs.
+def build_neighbor_index(data_points):
+    return cKDTree(np.asarray(data_points, dtype=float))
+
+
+# index is the tree from build_neighbor_index.
+# specific_points is an (m, dim) array of settings of the independent variables.
+# k is the number of nearest neighbors to find for each of them.
+# batch_size is how many points to query at once; 0 picks a size that bounds the temporary arrays.
+# This function returns an (m, k) array whose row i holds the indices of the k nearest neighbors of point i,
+#  in the same order that indices_of_NNs returns them: by distance, with ties broken by lower index.
+def batch_indices_of_NNs(index, specific_points, k, norm=2, batch_size=0):
+    data_points = index.data
+    n, dim = data_points.shape
+    specific_points = np.asarray(specific_points, dtype=float).reshape(-1, dim)
+    m = len(specific_points)
+    
+    if (k > n):
+        print("Warning! You're asking for more nearest neighbors than there are available points.") 
+    if (k >= n):
+        return np.broadcast_to(np.arange(n), (m, n))
+    if not batch_size:
+        batch_size = max(1, 2**22 // ((k + 1)*dim))
+    
+    neighbors = np.empty((m, k), dtype=np.intp)
+    for start in range(0, m, batch_size):
+        P = specific_points[start:start + batch_size]
+        
+        # Ask the tree for one extra neighbor, so that we can tell when the k-th neighbor is tied with the next.
+        radii, candidates = index.query(P, k=k + 1, p=norm)
+        # Recompute the distances exactly as indices_of_NNs does, then sort by distance and then by index.
+        distances = lN_distances(data_points[candidates], P[:, np.newaxis, :], norm)
+        order = np.lexsort((candidates, distances))
+        candidates = np.take_along_axis(candidates, order, axis=1)
+        distances = np.take_along_axis(distances, order, axis=1)
+        neighbors[start:start + len(P)] = candidates[:, :k]
+        
+        # If there is a tie at the boundary, more than k+1 points may be tied;
+        #  gather every point within the boundary radius and keep the lowest indices among the ties.
+        ties = np.flatnonzero(distances[:, k] - distances[:, k - 1] <= 1e-12*distances[:, k])
+        if len(ties):
+            balls = index.query_ball_point(P[ties], np.max(radii[ties], axis=1)*(1 + 1e-9), p=norm)
+            for tie, ball in zip(ties, balls):
+                ball = np.sort(ball)
+                ball_distances = lN_distances(data_points[ball], P[tie], norm)
+                neighbors[start + tie] = ball[np.argsort(ball_distances, kind='mergesort')[:k]]
+    
+    return neighbors
+
+
+# When k = n-1 (as in SBM), the k nearest neighbors of a point are all the training points but one:
+#  the one that batch_indices_of_NNs would put last, i.e., the farthest, with ties broken by higher index.
+# This returns the length-m array of the index of the training point left out of the neighborhood of each point,
+#  computing one row of distances per point instead of sorting them.
+def batch_indices_of_farthest(index, specific_points, norm=2, batch_size=0):
+    data_points = index.data
+    n, dim = data_points.shape
+    specific_points = np.asarray(specific_points, dtype=float).reshape(-1, dim)
+    m = len(specific_points)
+    if not batch_size:
+        batch_size = max(1, 2**22 // (n*dim))
+    
+    farthest = np.empty(m, dtype=np.intp)
+    for start in range(0, m, batch_size):
+        distances = lN_distances(data_points, specific_points[start:start + batch_size, np.newaxis, :], norm)
+        # argmax finds the first of tied maxima, so search the columns in reverse for the highest index.
+        farthest[start:start + len(distances)] = n - 1 - np.argmax(distances[:, ::-1], axis=1)
+    return farthest
+
+
+# Find the neighborhood of every one of the (shifted) points Ps, with the k nearest neighbors of each in the index.
+# Returns the (number of neighborhoods, k) int32 array of the distinct neighborhoods (sorted training indices),
+#  and the length-m int32 array of the neighborhood ID of every point, with IDs in order of first appearance.
+# If k >= n-1 (as in SBM), the neighborhoods are found without any neighbor search:
+#  there is just one (all the training points) if k >= n, or one per distinct farthest training point if k = n-1.
+def find_neighborhoods(index, Ps, k, norm=2):
+    n = len(index.data)
+    if k >= n - 1:
+        if k > n:
+            print("Warning! You're asking for more nearest neighbors than there are available points.") 
+        left_out = batch_indices_of_farthest(index, Ps, norm) if k == n - 1 else np.full(len(Ps), n)
+        left_out_ids, first, nbhd_of_point = np.unique(left_out, return_index=True, return_inverse=True)
+        # Renumber the neighborhoods in order of first appearance.
+        by_appearance = np.argsort(first)
+        renumber = np.empty(len(first), dtype=np.int32)
+        renumber[by_appearance] = np.arange(len(first), dtype=np.int32)
+        everyone = np.arange(n, dtype=np.int32)
+        neighborhoods = np.array([everyone[everyone != left] for left in left_out_ids[by_appearance]], dtype=np.int32)
+        return neighborhoods.reshape(len(first), -1), renumber[nbhd_of_point.ravel()]
+    
+    # Otherwise, find the neighbors of the points in batches, and sort the points into their neighborhoods.
+    table = NeighborhoodTable(k)
+    nbhd_of_point = np.empty(len(Ps), dtype=np.int32)
+    batch_size = max(1, 2**22 // max(1, k))
+    for start in range(0, len(Ps), batch_size):
+        neighbors = batch_indices_of_NNs(index, Ps[start:start + batch_size], k, norm=norm)
+        nbhd_of_point[start:start + batch_size] = table.add(neighbors)
+    return table.neighborhoods(), nbhd_of_point
+
+
+# Registry of the distinct neighborhoods found so far.
+# A neighborhood is stored as a sorted int32 array of training indices,
+#  and is looked up by the bytes of that array, which hash quickly.
+# Neighborhood IDs are handed out in order of first appearance.
+class NeighborhoodTable:
+    def __init__(self, k):
+        self.k = k
+        self.ids = {}
+        self.blocks = []
+        self.count = 0
+    
+    def __len__(self):
+        return self.count
+    
+    # neighbors is an (m, k) array of neighbor indices, as from batch_indices_of_NNs.
+    # Returns the length-m int32 array of the neighborhood ID of every row.
+    def add(self, neighbors):
+        keys = np.ascontiguousarray(np.sort(neighbors, axis=1), dtype=np.int32)
+        if not len(keys):
+            return np.empty(0, dtype=np.int32)
+        # View every row as one opaque value, so duplicate rows can be collapsed with np.unique.
+        rows = keys.view(np.dtype((np.void, keys.itemsize*keys.shape[1]))).ravel()
+        _, first, inverse = np.unique(rows, return_index=True, return_inverse=True)
+        
+        unique_ids = np.empty(len(first), dtype=np.int32)
+        new_rows = []
+        for u in np.argsort(first):
+            key = rows[first[u]].tobytes()
+            nbhd = self.ids.get(key)
+            if nbhd is None:
+                nbhd = self.ids[key] = self.count
+                self.count += 1
+                new_rows.append(first[u])
+            unique_ids[u] = nbhd
+        if new_rows:
+            self.blocks.append(keys[new_rows])
+        return unique_ids[inverse.ravel()]
+    
+    # Returns the (number of neighborhoods, k) int32 array of all neighborhoods, indexed by ID.
+    def neighborhoods(self):
+        if len(self.blocks) > 1:
+            self.blocks = [np.concatenate(self.blocks)]
+        return self.blocks[0] if self.blocks else np.empty((0, self.k), dtype=np.int32)
+
+
+# Approximate neighborhood sharing: neighborhoods (the rows of an array of sorted training indices, as from
+#  NeighborhoodTable) that overlap a representative neighborhood with a Jaccard index of at least threshold
+#  share the representative's local model, instead of each being fit separately.
+# Neighborhoods are visited in order, and each one is assigned to the candidate representative it overlaps most
+#  (the first on ties), or becomes a new representative if none is close enough.
+# Candidates are found with MinHash locality-sensitive hashing, so the cost stays linear in the number of neighborhoods:
+#  each representative is filed in one bucket per band, keyed by bands*rows minimum hashes of its points in each band,
+#  and two neighborhoods with Jaccard index J land in the same bucket of a band with probability J**rows.
+#  rows is chosen so that a neighborhood at the threshold collides in a band about half of the time,
+#  which misses it in all bands with probability about 2**-bands; each bucket keeps only its last window representatives.
+# Returns the int32 array with the ID of the representative of every neighborhood (its own ID for representatives).
+def share_neighborhoods(neighborhoods, threshold, bands=8, window=64):
+    m, k = neighborhoods.shape
+    # For two sets of k points with o in common, the Jaccard index o/(2k - o) >= threshold exactly when:
+    min_overlap = int(np.ceil(2*k*threshold/(1 + threshold) - 1e-9))
+    rows = 16 if threshold >= 1 else int(np.clip(np.log(0.5)/np.log(max(threshold, 1e-9)), 1, 16))
+    rng = np.random.default_rng(0)
+    point_hashes = rng.integers(0, 2**62, size=(bands*rows, int(neighborhoods.max()) + 1 if m else 0))
+    buckets = [{} for band in range(bands)]
+    rep_of = np.empty(m, dtype=np.int32)
+    chunk = max(1, 2**21 // (bands*rows*k))
+    for start in range(0, m, chunk):
+        block = neighborhoods[start:start + chunk]
+        # (neighborhoods, bands, rows) minimum hashes, one bucket key per band.
+        signatures = np.ascontiguousarray(point_hashes[:, block].min(axis=2).T).reshape(len(block), bands, rows)
+        for nbhd, N, signature in zip(range(start, start + len(block)), block, signatures):
+            keys = [band.tobytes() for band in signature]
+            lists = [buckets[band][key] for band, key in enumerate(keys) if key in buckets[band]]
+            best = -1
+            if lists:
+                candidates = np.fromiter(set(chain.from_iterable(lists)), dtype=np.int64)
+                # The overlap of every candidate with the neighborhood, by looking up its points in the sorted neighborhood.
+                members = neighborhoods[candidates]
+                found = N[np.minimum(np.searchsorted(N, members), k - 1)] == members
+                overlaps = np.count_nonzero(found, axis=1)
+                top = np.flatnonzero(overlaps == overlaps.max())
+                top = top[np.argmin(candidates[top])]
+                if overlaps[top] >= min_overlap:
+                    best = candidates[top]
+            if best < 0:
+                rep_of[nbhd] = nbhd
+                for band, key in enumerate(keys):
+                    if key not in buckets[band]:
+                        buckets[band][key] = deque(maxlen=window)
+                    buckets[band][key].append(nbhd)
+            else:
+                rep_of[nbhd] = best
+    return rep_of
+
+
+# Fit exact models for a random sample of up to args.shareCheck of the evaluation points whose neighborhood shares
+#  another's model (where rep_of[exact_of_point] differs from exact_of_point), and log how much their predictions change.
+# neighborhoods are the exact neighborhoods and predictions are those made with the shared models, in the order of Ps
+#  (with a column for each dependent variable).
+def check_shared_predictions(neighborhoods, rep_of, exact_of_point, Ps, predictions, training, args, pool=None):
+    shared = np.flatnonzero(rep_of[exact_of_point] != exact_of_point)
+    if not len(shared):
+        return
+    sample = np.sort(np.random.default_rng(0).choice(shared, min(args.shareCheck, len(shared)), replace=False))
+    exact_ids, nbhd_of_sample = np.unique(exact_of_point[sample], return_inverse=True)
+    models = fit_neighborhoods(neighborhoods[exact_ids], training, args, pool)
+    exact = np.empty((len(sample), predictions.shape[1]))
+    for nbhd, model in enumerate(models):
+        in_nbhd = nbhd_of_sample == nbhd
+        exact[in_nbhd] = evaluate_neighborhood(model, 0, Ps[sample[in_nbhd]], args)[:, 2:2 + predictions.shape[1]]
+    change = predictions[sample] - exact
+    log(f"{len(shared)} of {len(Ps)} points use a shared local model; over a sample of {len(sample)} of them, "
+        f"predictions changed from exact neighborhoods by {np.sqrt(np.mean(change**2))} RMS and {np.max(np.abs(change))} at most.\n", 
+        file=args.logFile)
+
+
+# The distinct rows of Ps, in the order of their first appearance, and the index (in those) of every row of Ps.
+def unique_rows(Ps):
+    unique, first, inverse = np.unique(Ps, axis=0, return_index=True, return_inverse=True)
+    by_appearance = np.argsort(first)
+    renumber = np.empty(len(first), dtype=np.intp)
+    renumber[by_appearance] = np.arange(len(first))
+    return unique[by_appearance], renumber[inverse.ravel()]
+
+
+# Given the neighborhood ID of every evaluation point, 
+#  this returns the permutation of the points that sorts them by neighborhood (stable within a neighborhood),
+#  and the offsets such that order[starts[g]:starts[g+1]] are the points in neighborhood g.
+def group_by_neighborhood(nbhd_of_point, num_nbhds):
+    order = np.argsort(nbhd_of_point, kind='stable')
+    starts = np.zeros(num_nbhds + 1, dtype=np.intp)
+    np.cumsum(np.bincount(nbhd_of_point, minlength=num_nbhds), out=starts[1:])
+    return order, starts
+
+
 # indep_data_points is a list of the observed independent variables to build models from.
 # dep_data_points is a list of the observed dependent variables (in the same order).
 # args.k is the number of folds or partitions to divide the data into.
@@ -269,19 +908,33 @@ def indices_of_NNs(data_points, specific_point, k, norm=2):
 # args.degree is the max degree.
 # args.lasso is 0 to not use Lasso method, or a small positive float as a Lasso parameter.
 # args.iter_rand is positive if we want to try that many random term selections instead of Lasso.
+# The design matrix is only built once, for the max degree, since the columns of each lower degree are a prefix of it.
+# For each partition, the contribution of every fold to AtA and AtZ is computed once,
+#  and the system for each training set (all folds but one) is found by subtracting the testing fold's contribution.
+# This returns the winning degree, the Total_SSE of every degree, and the coefficients of every fold for the winning degree
+#  (see select_degree).
 def crossvalidation(indep_data_points, dep_data_points, args):#k, num_random_partitions, D, lasso, iter_rand):
+    Total_SSE, rand_coef_log = crossvalidation_errors(indep_data_points, dep_data_points, args)
+    return select_degree(Total_SSE, rand_coef_log, args.degree)
+
+
+# The cross-validation of crossvalidation, up to the selection of the degree.
+# Returns the Total_SSE of every degree up to args.degree (with a column per target, if there are several),
+#  and the coefficients of every fold for every degree, from the last partition.
+def crossvalidation_errors(indep_data_points, dep_data_points, args):
     
-    # Number of data points.
-    n = len(indep_data_points)
+    indep_data_points = np.asarray(indep_data_points, dtype=float)
+    dep_data_points = np.asarray(dep_data_points, dtype=float)
     
-    # A list of 0's of same length as possible degrees.
-    Total_SSE = np.zeros(args.degree + 1)
+    # Number of data points, and the number of monomials of each degree up to the max.
+    n, dim = indep_data_points.shape
+    terms = [num_terms(dim, d, basis_of(args)) for d in range(args.degree + 1)]
+    A = design_matrix(indep_data_points, args.degree, basis_of(args))
     
-    indices = list(range(n))
+    # A list of 0's of same length as possible degrees (with a column per target, if there are several).
+    Total_SSE = np.zeros((args.degree + 1,) + dep_data_points.shape[1:])
     
-    winning_seeds = np.zeros(args.degree + 1)
-    if args.randIters:
-        lowest_SSE = [999]*(args.degree + 1)
+    indices = list(range(n))
     
     for iteration in range(args.cvIters):
         # Randomly partition the data into k sets as equally sized as possible.
@@ -291,6 +944,14 @@ def crossvalidation(indep_data_points, dep_data_points, args):#k, num_random_par
         random.shuffle(indices)
         Folds = [ [indices[i] for i in range(fold, n, args.k)] for fold in range(args.k) ]
         
+        # The rows of every fold, and their contributions to the normal equations.
+        fold_As = [A[fold] for fold in Folds]
+        fold_Zs = [dep_data_points[fold] for fold in Folds]
+        fold_AtAs = [np.dot(fold_A.T, fold_A) for fold_A in fold_As]
+        fold_AtZs = [np.dot(fold_A.T, fold_Z) for fold_A, fold_Z in zip(fold_As, fold_Zs)]
+        AtA = sum(fold_AtAs)
+        AtZ = sum(fold_AtZs)
+        
         ##########################
         rand_coef_log = {}
         
@@ -299,58 +960,178 @@ def crossvalidation(indep_data_points, dep_data_points, args):#k, num_random_par
             
             ############################
             rand_coef_log[d] = {}
+            T = terms[d]
             
-            #print(d, Folds)
-
             # Build k models of degree d (each model reserves one set as testing set).
             for testing_fold in range(args.k):
-                testing_indep_data = [ indep_data_points[i] for i in Folds[testing_fold] ]
-                testing_dep_data = [ dep_data_points[i] for i in Folds[testing_fold] ]
-                
-                model_indep_data = []
-                model_dep_data = []
-                for fold in range(args.k):
-                    if fold != testing_fold:
-                        model_indep_data.extend([ indep_data_points[i] for i in Folds[fold] ])
-                        model_dep_data.extend([ dep_data_points[i] for i in Folds[fold] ])
+                testing_A = fold_As[testing_fold][:, :T]
+                testing_dep_data = fold_Zs[testing_fold]
+                num_model_points = n - len(testing_dep_data)
                 
-                best_SSE = 9999
-                for i in range(max(1, args.randIters)):
-                    SSE = 0
-                    # Get the polynomial built from the model data of degree d.
+                # If the polynomial is degree zero, it is just the average of the model data.
+                # Otherwise, try to solve the normal equations of the model data directly (for all targets at once).
+                try:
+                    if not d:
+                        coefficients = np.array([(AtZ[0] - fold_AtZs[testing_fold][0])/num_model_points])
+                    elif num_model_points < T:
+                        coefficients = None
+                    else:
+                        coefficients = solve_normal_equations(AtA[:T, :T] - fold_AtAs[testing_fold][:T, :T], 
+                                                              AtZ[:T] - fold_AtZs[testing_fold][:T])
+                except Exception:
+                    count("crossvalidation.solve_exceptions")
+                    coefficients = None
+                if d:
+                    count("crossvalidation.normal_equations" if coefficients is not None else "crossvalidation.deficient")
                     
-                    try:
-                        rand_state = random.getstate()
-                        coefficients = determine_coefficients(model_indep_data, model_dep_data, d, args.Lasso, args.randIters)
-                        
-                        ############################
-                        rand_coef_log[d][frozenset(Folds[testing_fold])] = coefficients
-                        
-                        # Predict the testing points and add the error to the Total_SSE[d].
-                        for x, z in zip(testing_indep_data, testing_dep_data):
-                            # The square of the difference between polynomial prediction and observed value (z) at x.
-                            SSE += (evaluate_polynomial(coefficients, d, x) - z)**2    
-                        #print(f"d: {d}; Total_SSA[d]: {Total_SSE[d]}; \ncoefficients: 
-                        if SSE <= best_SSE:
-                            best_SSE = SSE
-                            if args.randIters and (SSE < lowest_SSE[d]):
-                                lowest_SSE[d] = SSE
-                                winning_seeds[d] = rand_state
-                    except:
-                        SSE = 9999
+                # If the system is rank deficient, fall back to the methods
+                #  for under-determined systems on the rows of the model data, one target at a time.
+                # The coefficients of the targets for which that fails are NaN.
+                logged = coefficients
+                if coefficients is None:
+                    model_rows = np.concatenate([fold_As[fold][:, :T] for fold in range(args.k) if fold != testing_fold])
+                    model_dep_data = np.concatenate([fold_Zs[fold] for fold in range(args.k) if fold != testing_fold])
+                    coefficients = np.full((T,) + dep_data_points.shape[1:], np.nan)
+                    logged = coefficients.copy()
+                    for target in np.ndindex(dep_data_points.shape[1:]):
+                        column = (slice(None),) + target
+                        try:
+                            # Random term selection tries args.randIters sets of terms, all fit and scored in one batch.
+                            # The SSE is that of the best set, but the coefficients logged (for the final model)
+                            #  are those of the last set tried, as when the sets were tried one at a time.
+                            if args.randIters and not args.Lasso:
+                                _, coefficients[column], logged[column] = best_random_terms(
+                                    model_rows, model_dep_data[column], testing_A, testing_dep_data[column], args.randIters)
+                            else:
+                                coefficients[column] = coefficients_from_design(model_rows, model_dep_data[column], d, 
+                                                                                args.Lasso, args.randIters)
+                                logged[column] = coefficients[column]
+                        except Exception:
+                            count("crossvalidation.fit_exceptions")
+                
+                ############################
+                rand_coef_log[d][testing_fold] = logged
                 
-                Total_SSE[d] += best_SSE
+                # Predict the testing points and add the error to the Total_SSE[d].
+                # The square of the difference between polynomial prediction and observed value (z) at x.
+                residuals = np.dot(testing_A, coefficients) - testing_dep_data
+                SSE = sum_of_squares(residuals)
+                Total_SSE[d] += np.where(np.isnan(SSE), 9999, np.minimum(SSE, 9999))
+
+    return Total_SSE, rand_coef_log
+
 
+# Select the degree, up to max_degree, with the least Total_SSE from crossvalidation_errors.
+# Returns the winning degree, the Total_SSE of every degree up to max_degree, 
+#  and the coefficients of every fold for the winning degree (as the rand state of determine_coefficients).
+# With several targets, this is done for each of them, and a list of their results is returned.
+def select_degree(Total_SSE, rand_coef_log, max_degree):
+    Total_SSE = Total_SSE[:max_degree + 1]
+    
     # Return index of minimum Total_SSE.
     # Note: Total_SSE[i] corresponds to polynomial of degree i.
-    winning_degree = np.argmin(Total_SSE)
+    winning_degree = np.argmin(Total_SSE, axis=0)
     
-    ############################
-    #print(rand_coef_log[winning_degree])
+    # The coefficients of each fold of the winning degree, skipping the folds that failed.
+    def winning_coefficients(degree, target=()):
+        column = (slice(None),) + target
+        return {fold: list(coefficients[column]) for fold, coefficients in rand_coef_log[degree].items() 
+                if not np.isnan(coefficients[column][0])}
     
-    #print(f"n: {n}; winning_degree: {winning_degree}; \nTotal_SSE: {Total_SSE}\n")
-    #print(f"Total_SSE: {Total_SSE}")
-    return [winning_degree, list(Total_SSE), rand_coef_log[winning_degree]]#winning_seeds[winning_degree]]
+    if Total_SSE.ndim == 1:
+        return [winning_degree, list(Total_SSE), winning_coefficients(winning_degree)]
+    return [[winning_degree[target], list(Total_SSE[:, target]), winning_coefficients(winning_degree[target], (target,))] 
+            for target in range(Total_SSE.shape[1])]
+
+
+# The sum of squares of residuals, or of each of its columns if it is 2-D.
+def sum_of_squares(residuals):
+    if residuals.ndim == 1:
+        return np.dot(residuals, residuals)
+    return np.einsum('ij,ij->j', residuals, residuals)
+
+
+# crossvalidation_errors for a batch of neighborhoods of the same size at once: 
+#  X is the (B, n, dim) array of their independent variables and Z is the (B, n) array of their dependent variables
+#  (or (B, n, R), with R dependent variables).
+# Every neighborhood is partitioned as crossvalidation_errors would partition it on its own (drawing from the random stream 
+#  in the same order), and the systems of all the neighborhoods and folds of a degree are solved together 
+#  with batch_solve_normal_equations; the rank-deficient ones fall back, one at a time, as in crossvalidation_errors.
+# Returns the (degree + 1, B, R) array of the Total_SSE of every degree, neighborhood, and target,
+#  and the (folds, B, terms, R) coefficients of every degree, from the last partition (NaN where a fit failed).
+def batch_crossvalidation_errors(X, Z, args):
+    B, n, dim = X.shape
+    Z = np.asarray(Z, dtype=float).reshape(B, n, -1)
+    terms = [num_terms(dim, d, basis_of(args)) for d in range(args.degree + 1)]
+    A = design_matrix(X.reshape(B*n, dim), args.degree, basis_of(args)).reshape(B, n, terms[-1])
+    Total_SSE = np.zeros((args.degree + 1, B, Z.shape[2]))
+    
+    # The partitions of each neighborhood, drawn one neighborhood after another, as separate calls of crossvalidation_errors would.
+    partitions = np.empty((args.cvIters, B, n), dtype=np.intp)
+    for b in range(B):
+        indices = list(range(n))
+        for iteration in range(args.cvIters):
+            random.shuffle(indices)
+            partitions[iteration, b] = indices
+    
+    for iteration in range(args.cvIters):
+        Folds = [partitions[iteration][:, fold::args.k] for fold in range(args.k)]
+        fold_As = [np.take_along_axis(A, fold[:, :, None], axis=1) for fold in Folds]
+        fold_Zs = [np.take_along_axis(Z, fold[:, :, None], axis=1) for fold in Folds]
+        fold_AtAs = np.stack([np.matmul(fold_A.transpose(0, 2, 1), fold_A) for fold_A in fold_As])
+        fold_AtZs = np.stack([np.matmul(fold_A.transpose(0, 2, 1), fold_Z) for fold_A, fold_Z in zip(fold_As, fold_Zs)])
+        AtA = np.sum(fold_AtAs, axis=0)
+        AtZ = np.sum(fold_AtZs, axis=0)
+        num_model_points = np.array([n - len(fold[0]) for fold in Folds])
+        
+        rand_coef_log = {}
+        for d in range(args.degree + 1):
+            T = terms[d]
+            if not d:
+                coefficients = (AtZ[None, :, :1] - fold_AtZs[:, :, :1])/num_model_points[:, None, None, None]
+            else:
+                coefficients = np.full((args.k, B, T, Z.shape[2]), np.nan)
+                deficient = np.ones((args.k, B), dtype=bool)
+                solvable = np.flatnonzero(num_model_points >= T)
+                if len(solvable):
+                    solved, full_rank = batch_solve_normal_equations(
+                        (AtA[None, :, :T, :T] - fold_AtAs[solvable, :, :T, :T]).reshape(-1, T, T), 
+                        (AtZ[None, :, :T] - fold_AtZs[solvable, :, :T]).reshape(-1, T, Z.shape[2]))
+                    coefficients[solvable] = solved.reshape(len(solvable), B, T, Z.shape[2])
+                    deficient[solvable] = ~full_rank.reshape(len(solvable), B)
+                num_deficient = int(np.count_nonzero(deficient))
+                count("crossvalidation.normal_equations", deficient.size - num_deficient)
+                if num_deficient:
+                    count("crossvalidation.deficient", num_deficient)
+                
+                # Fall back for the rank-deficient systems to the rows of their model data: 
+                #  first to least squares on all of them at once (as coefficients_from_design would try first),
+                #  and then for those that are still rank deficient, to coefficients_from_design, one target at a time.
+                for testing_fold in np.flatnonzero(np.any(deficient, axis=1)):
+                    nbhds = np.flatnonzero(deficient[testing_fold])
+                    others = [fold for fold in range(args.k) if fold != testing_fold]
+                    model_rows = np.concatenate([fold_As[fold][nbhds, :, :T] for fold in others], axis=1)
+                    model_dep_data = np.concatenate([fold_Zs[fold][nbhds] for fold in others], axis=1)
+                    solved, full_rank = batch_solve_least_squares(model_rows, model_dep_data)
+                    coefficients[testing_fold, nbhds] = solved
+                    if np.any(full_rank):
+                        count("solver.solve", int(np.count_nonzero(full_rank))*Z.shape[2])
+                    for g in np.flatnonzero(~full_rank):
+                        for target in range(Z.shape[2]):
+                            try:
+                                coefficients[testing_fold, nbhds[g], :, target] = coefficients_from_design(
+                                    model_rows[g], model_dep_data[g, :, target], d, args.Lasso, args.randIters)
+                            except Exception:
+                                count("crossvalidation.fit_exceptions")
+            rand_coef_log[d] = coefficients
+            
+            # Predict the testing points of every fold and add the errors to the Total_SSE[d].
+            for testing_fold in range(args.k):
+                residuals = np.matmul(fold_As[testing_fold][:, :, :T], coefficients[testing_fold]) - fold_Zs[testing_fold]
+                SSE = np.einsum('btr,btr->br', residuals, residuals)
+                Total_SSE[d] += np.where(np.isnan(SSE), 9999, np.minimum(SSE, 9999))
+    
+    return Total_SSE, rand_coef_log
 
 
 # Used by model_at_point to determine local model degree.
@@ -359,6 +1140,8 @@ def determine_model_degree(indep, dep, args):
         # Setting the degree to 0 forces us to just average the nearest neighbors.
         # This is exactly kNN (a degree 0 polynomial).
         degree_with_errors = [0, [], 0]
+        if np.ndim(dep) > 1:
+            degree_with_errors = [degree_with_errors]*np.shape(dep)[1]
 
     elif args.model in ["SBM", "HYPPO"]:#=="SBM":
         degree_with_errors = crossvalidation(indep, dep, args)
@@ -369,14 +1152,29 @@ def determine_model_degree(indep, dep, args):
     return degree_with_errors
     
 
+# With several dependent variables (the columns of a 2-D selected_dep_data), 
+#  this returns a list of the degree, errors, and coefficients of each of them.
 def create_model(selected_indep_data, selected_dep_data, args):
     # Determine the best polynomial degree.
-    degree, errors, rand_state = determine_model_degree(selected_indep_data, selected_dep_data, args)
+    selection = determine_model_degree(selected_indep_data, selected_dep_data, args)
+    return fit_selected_degree(selected_indep_data, selected_dep_data, selection, args)
+
+
+# The rest of create_model, given the [degree, errors, rand_state] from determine_model_degree
+#  (or the list of them, with several dependent variables).
+def fit_selected_degree(selected_indep_data, selected_dep_data, selection, args):
+    if np.ndim(selected_dep_data) > 1:
+        degrees, errors, rand_states = zip(*selection)
+        coefficients = determine_target_coefficients(selected_indep_data, selected_dep_data, degrees, args.Lasso, rand_states, 
+                                                     basis_of(args))
+        return list(zip(degrees, errors, coefficients))
+    
+    degree, errors, rand_state = selection
     
     # Compute the coefficients of the "best" polynomial of degree degree.
     #print("types:", type(selected_indep_data), type(selected_dep_data), type(degree), type(args.Lasso))
     #print(f"selected_indep_data: {selected_indep_data}\nselected_dep_data: {selected_dep_data}\ndegree: {degree}\nargs.Lasso: {args.Lasso}\nrand_state: {rand_state}")
-    coefficients = determine_coefficients(selected_indep_data, selected_dep_data, degree, args.Lasso, rand_state)
+    coefficients = determine_coefficients(selected_indep_data, selected_dep_data, degree, args.Lasso, rand_state, basis_of(args))
     
     return degree, errors, coefficients
 
@@ -384,62 +1182,168 @@ def create_model(selected_indep_data, selected_dep_data, args):
 # Main function for a single neighborhood.
 # This function will be called independently many time.
 # This can be run on every element of a Spark RDD.
-def model_in_neighborhood(selected_indep_data, selected_dep_data, args):
+# With a NeighborhoodDiagnostics collector, the fit is recorded in it.
+def model_in_neighborhood(selected_indep_data, selected_dep_data, args, diagnostics=None):
 
-    degree, errors, coefficients = create_model(selected_indep_data, selected_dep_data, args)
+    t0 = time()
+    models = create_model(selected_indep_data, selected_dep_data, args)
+    seconds = time() - t0
+    
+    # With several dependent variables, there is a model for each, which are recorded separately
+    #  (with an equal share of the time).
+    several = np.ndim(selected_dep_data) > 1
+    if not several:
+        models = [models]
+    if diagnostics is not None:
+        for degree, errors, coefficients in models:
+            # The number of coefficients of each degree.
+            counts = degree_counts(coefficients, len(selected_indep_data[0]), degree, basis_of(args)) or []
+            diagnostics.record(len(selected_dep_data), degree, errors, counts, seconds/len(models))
+    if METRICS is not None:
+        METRICS.count("models.fit")
+        METRICS.histogram("fit_milliseconds", [int(1000*seconds)])
+
+    models = [[degree, coefficients] for degree, errors, coefficients in models]
+    return models if several else models[0]
+
+
+# Fit the models of a batch of neighborhoods of the degrees marked in selected, a (degree + 1, B, R) boolean array 
+#  over the degrees, neighborhoods, and targets, from the output of batch_crossvalidation_errors:
+#  A is the (B, n, terms) array of their design matrices up to args.degree, Z is the (B, n, R) array of their dependent variables,
+#  and dim is the number of independent variables.
+# The models of each degree are fit together with batch_solve_least_squares, 
+#  falling back to coefficients_from_design for the rank-deficient ones.
+# Returns the (degree + 1, B, R) object array of the coefficients (None where a degree isn't selected).
+def fit_degrees(A, Z, dim, selected, rand_coef_log, args):
+    coefficients = np.empty(selected.shape, dtype=object)
+    for degree in np.flatnonzero(np.any(selected, axis=(1, 2))):
+        T = num_terms(dim, degree, basis_of(args))
+        nbhds = np.flatnonzero(np.any(selected[degree], axis=1))
+        if not degree:
+            count("solver.mean", int(np.count_nonzero(selected[degree])))
+            coef, full_rank = np.mean(Z[nbhds], axis=1, keepdims=True), np.ones(len(nbhds), dtype=bool)
+        else:
+            coef, full_rank = batch_solve_least_squares(A[nbhds, :, :T], Z[nbhds])
+            count("solver.solve", int(np.count_nonzero(selected[degree][nbhds] & full_rank[:, None])))
+        for g, b in enumerate(nbhds):
+            for target in np.flatnonzero(selected[degree, b]):
+                if full_rank[g]:
+                    coefficients[degree, b, target] = list(coef[g, :, target])
+                else:
+                    # The coefficients of each fold of the degree, skipping the folds that failed (as in select_degree).
+                    rand_state = {fold: list(fold_coefs) for fold, fold_coefs in enumerate(rand_coef_log[degree][:, b, :, target]) 
+                                  if not np.isnan(fold_coefs[0])}
+                    coefficients[degree, b, target] = coefficients_from_design(A[b, :, :T], Z[b, :, target], degree, args.Lasso, rand_state)
+    return coefficients
 
-    if args.degreeCountFile:
-        # Dumps a line with number of coefficients of each degree into a file.        
-        with open(args.degreeCountFile, "a+") as degreeCount_dump:
-            #print(coefs, len(independent_variable_points[0]), degree)
-            counts = degree_counts(coefficients, len(selected_indep_data[0]), degree)
-            #print(counts)
-            degreeCount_dump.write(",".join([str(count) for count in counts]) + "\n")
 
+# model_in_neighborhood for a batch of neighborhoods of the same size (an array with one row of training indices each) at once:
+#  they are cross-validated together (see batch_crossvalidation_errors), and the models of the winning degrees
+#  are fit together (see fit_degrees).
+# With a NeighborhoodDiagnostics collector, the fits are recorded in it, each with an equal share of the time of the batch.
+# Returns the model of every neighborhood, as from model_in_neighborhood.
+def models_in_neighborhoods(neighborhoods, indep, dep, args, diagnostics=None):
+    t0 = time()
+    B, n = neighborhoods.shape
+    X = np.asarray(indep[neighborhoods], dtype=float)
+    Z = np.asarray(dep[neighborhoods], dtype=float).reshape(B, n, -1)
+    Total_SSE, rand_coef_log = batch_crossvalidation_errors(X, Z, args)
+    winning_degree = np.argmin(Total_SSE, axis=0)
+    
+    A = design_matrix(X.reshape(B*n, -1), args.degree, basis_of(args)).reshape(B, n, -1)
+    selected = np.arange(args.degree + 1)[:, None, None] == winning_degree
+    coefficients = np.take_along_axis(fit_degrees(A, Z, X.shape[2], selected, rand_coef_log, args), winning_degree[None], axis=0)[0]
+    seconds = (time() - t0)/B
+    
+    if diagnostics is not None:
+        for b, target in np.ndindex(winning_degree.shape):
+            degree, coefs = winning_degree[b, target], coefficients[b, target]
+            counts = degree_counts(coefs, X.shape[2], degree, basis_of(args)) or []
+            diagnostics.record(n, degree, list(Total_SSE[:, b, target]), counts, seconds/winning_degree.shape[1])
+    if METRICS is not None:
+        METRICS.count("models.fit", B)
+        METRICS.histogram("fit_milliseconds", [int(1000*seconds)]*B)
+    
+    models = [[[degree, coefs] for degree, coefs in zip(degrees, coefs_of_targets)] 
+              for degrees, coefs_of_targets in zip(winning_degree.tolist(), coefficients)]
+    return models if np.ndim(dep) > 1 else [targets[0] for targets in models]
+
+
+# A collector for the diagnostics of the local models, if any of the diagnostic outputs are requested; otherwise None.
+def open_diagnostics(args):
+    if args.errorFile or args.degreeCountFile or args.diagnosticsFile:
+        return NeighborhoodDiagnostics(args.degree)
+    return None
+
+
+# Write the diagnostics gathered over a run to the requested outputs.
+def write_diagnostics(diagnostics, args):
+    if diagnostics is None:
+        return
+    log(f"{diagnostics.summary()}\n", file=args.logFile)
+    if args.diagnosticsFile:
+        diagnostics.write(args.diagnosticsFile)
     if args.errorFile:
-        stored_errors[neighborhood] = errors
+        diagnostics.write_errors(args.errorFile)
+    if args.degreeCountFile:
+        diagnostics.write_degree_counts(args.degreeCountFile)
 
-    return [degree, coefficients]
 
+# The training data after preprocessing, and what is needed to preprocess evaluation points the same way.
+# indep is the (n, m) array of the shifted/scaled/flattened independent variables,
+#  dep is the array of the dependent variable (with a column for each, if there are several), index is the nearest-neighbor index over indep, and 
+#  columns is the slice of the evaluation data columns with the independent variables.
+TrainingData = namedtuple("TrainingData", ["indep", "dep", "index", "shift", "scale", "columns"])
 
-# input1 and input2 are arrays or ndarrays.
-# Columns index 0 and 1 of input1 and input2 are the x/y-coordinates.
-# input1 should have 1 more column than input2, the column with the dependent variable.
-# depIndex is the index of the dependent variable column in input1.
-# model is one of ["HYPPO", "KNN", "SBM"].
-# Implementations of HYPPO and SBM are not well-suited for high dimensional data.
-# k is the number of nearest neighbors for HYPPO or KNN (is overridden for SBM).
-def main(input1, input2, args):
+
+# The indices of the dependent variable columns in args.depIndex, which may be a comma-separated list of several.
+def dep_columns(args):
+    return [int(i) for i in str(args.depIndex).split(",")]
+
+
+# input1 is an array or ndarray of the training data, in which
+# columns index 0 and 1 are the x/y-coordinates, 
+# and depIndex is the index of the dependent variable column (or a list of several, see dep_columns).
+# eval_minimum is the minimum of every column of the evaluation data, which is only needed with args.Flatten.
+# This returns the TrainingData, and finalizes args (scale, Flatten, k, and cvIters) for model building.
+def prepare_training(input1, args, eval_minimum=None):
     
     indepStart = args.skipVars
+    depColumns = dep_columns(args)
     if args.variables:
         indepCount = args.variables
     else:
-        indepCount = input1.shape[1] - 1 - indepStart
+        indepCount = input1.shape[1] - len(depColumns) - indepStart
+    # The independent variables are counted from indepStart in the columns other than the dependent variables.
+    indep_columns = np.delete(np.arange(input1.shape[1]), depColumns)[indepStart:indepStart+indepCount]
 
     # If data is to be flattened (raised to some positive power, presumably less than one)
     #  then we need to shift it to all-positive values.
     if args.Flatten:
-        # Find the index of the minimum in ever column of the training data...
-        m1 = np.amin(input1, axis=0)
-        # --except the dependent variable--
-        m1 = np.delete(m1, args.depIndex)
+        # Find the index of the minimum in every independent column of the training data...
+        m1 = np.amin(input1[:, indep_columns], axis=0)
         # ... and in every column of the testing data
-        m2 = np.amin(input2, axis=0)
+        m2 = np.asarray(eval_minimum)[indepStart:indepStart+indepCount]
         # This shift forces every value of the predictors to be non-negative.
-        shift = np.minimum(m1,m2)[indepStart:indepStart+indepCount]
+        shift = np.minimum(m1,m2)
     else:
-        shift = np.mean(input1, axis=0)[indepStart:indepStart+indepCount]
+        if len(depColumns) > 1:
+            # Center every independent column (but not the dependent variables) on its mean.
+            shift = np.mean(input1[:, indep_columns], axis=0)
+        else:
+            # With one dependent variable, keep the shift hyppo has always used (the means of the columns from indepStart,
+            #  counting the dependent variable), so that its models stay the same: the shift cancels out of full-rank fits,
+            #  but not out of the Lasso term selection or the rank-deficient least-squares fallback.
+            shift = np.mean(input1, axis=0)[indepStart:indepStart+indepCount]
         args.Flatten = 1
 
-    # Extract from the training data the values for the dependent and independent variables. 
-    # ToDo: Use pandas for importing train data and spliting into indep and dep.
-    Independent_Data = []
-    Dependent_Data = []
-    for line in input1:
-        numbers = list(line)
-        Dependent_Data.append(numbers.pop(args.depIndex))
-        Independent_Data.append(np.array(numbers[indepStart:indepStart+indepCount]))
+    # Extract from the training data the values for the dependent and independent variables.
+    # With several dependent variables, Dependent_Data has a column for each.
+    if len(depColumns) > 1:
+        Dependent_Data = np.array(input1[:, depColumns], dtype=float, order="C")
+    else:
+        Dependent_Data = np.array(input1[:, depColumns[0]], dtype=float)
+    Independent_Data = np.array(input1[:, indep_columns], dtype=float, order="C")
 
     # Unless an array of scaling factors is specified, 
     #  every column will be divided by the standard deviation of that column
@@ -454,12 +1358,18 @@ def main(input1, input2, args):
     log(f"scale: {scale}\n", file=args.logFile)
 
     log(f"Dependent_Data is an array of length {len(Dependent_Data)} with first elements:\n{Dependent_Data[:5]}\n", file=args.logFile)
-    log(f"Independent_Data is a length-{len(Independent_Data)} array of arrays with first element:\n{Independent_Data[0]}\n", file=args.logFile)    
+    log(f"Independent_Data is a {Independent_Data.shape} array with first row:\n{Independent_Data[0]}\n", file=args.logFile)    
     
-    # Perform any shifting, scaling, and flattening on the training data.
+    # Perform any shifting, scaling, and flattening on the training data, in place.
     # The same operations will also be performed on the evaluation data later as necessary.
-    Independent_Data = [((row - shift)*scale)**args.Flatten for row in Independent_Data]
-    log(f"Independent_Data post-scaling is an array of arrays with first element:\n{Independent_Data[0]}\n", file=args.logFile)
+    Independent_Data -= shift
+    Independent_Data *= scale
+    if args.Flatten != 1:
+        Independent_Data **= args.Flatten
+    log(f"Independent_Data post-scaling is a {Independent_Data.dtype} array with first row:\n{Independent_Data[0]}\n", file=args.logFile)
+    
+    # Build the nearest-neighbor index over the training data once; the tree uses Independent_Data itself, not a copy.
+    index = build_neighbor_index(Independent_Data)
  
     # If SBM, we will need to shuffle and partition the training data multiple times, and use all data as neighbors.
     if args.model=="SBM":
@@ -469,101 +1379,658 @@ def main(input1, input2, args):
         args.cvIters = 1
     log(f"Each local model will be generated with {args.k} nearest neighbors.\n", file=args.logFile)
     
-    # Set up global dictionary for optional error dump.
-    if args.errorFile:
-        global stored_errors
-        stored_errors = {}
-    
-    # This is the operation that takes a point (X) and returns its coordinates (xy) and itself shifted (P).
-    def XtP(X):
-        xy = list(X[:2])
-        P = ((np.array(X[indepStart:indepStart+indepCount]) - shift)*scale)**args.Flatten
-        return (xy, P)
-        
-    # This is the operation that finds the neighborhood of a point (P).
-    def NoP(P):
-        indices_of_nearest_neighbors = indices_of_NNs(Independent_Data, P, args.k, norm=args.norm)
-        return frozenset(indices_of_nearest_neighbors)
-    
-    # This is the operation that finds the data for the neighbors of a neighborhood (N).
-    def DoN(N):
-        selected_indep_data = [ Independent_Data[i] for i in N ]
-        selected_dep_data = [ Dependent_Data[i] for i in N ]
-        return [selected_indep_data, selected_dep_data]
-    
-    # This is the operation that finds the degree and coefficients of the model 
-    #  for a neighborhood (Ndata = [indep_data, dep_data]).
-    def MiN(Ndata):
-        return model_in_neighborhood(Ndata[0], Ndata[1], args)
-               
-    # This is the operation that evaluates a local model (M = [deg, coefs]) at every point in a neighborhood (Ps).
-    def EoN(M, xyPs):
-        degree, coefs = M
-        zs = [evaluate_polynomial(coefs, degree, xyP[1]) for xyP in xyPs]
-        zs = [min(max(z, args.lowerBound), args.upperBound) for z in zs]
-        return [(xyP[0][0], xyP[0][1], z, degree) for (xyP, z) in zip(xyPs, zs)]
+    return TrainingData(Independent_Data, Dependent_Data, index, shift, scale, slice(indepStart, indepStart+indepCount))
+
+
+# Open the persistent cache of local models in args.cacheDir, or return a null context if there is none.
+# The cache key covers the preprocessed training data and every argument that changes how a local model is built.
+def open_model_cache(training, args):
+    if not args.cacheDir:
+        return nullcontext()
+    if len(dep_columns(args)) > 1:
+        log("The local model cache doesn't work with several dependent variables, so it won't be used.\n", file=args.logFile)
+        return nullcontext()
+    context = hashlib.sha256()
+    context.update(np.ascontiguousarray(training.indep).tobytes())
+    context.update(np.ascontiguousarray(training.dep).tobytes())
+    settings = (args.model, args.degree, args.Lasso, args.randIters, args.cvIters, list(np.atleast_1d(args.scale)), args.Flatten)
+    # A limited basis is only added when it is set, so that the caches of the full basis keep their keys.
+    if any(basis_of(args)):
+        settings += (tuple(basis_of(args)),)
+    context.update(repr(settings).encode())
+    log(f"Using the local model cache in {args.cacheDir}.\n", file=args.logFile)
+    return LocalModelCache(args.cacheDir, context.digest(), max_megabytes=args.cacheMaxMB, max_days=args.cacheMaxDays)
+
+
+# Fit the model of each of the neighborhoods (an array with one row of training indices each),
+#  with the pool from worker_pool if one is given, or in serial otherwise.
+# With a LocalModelCache, only the neighborhoods missing from the cache are fit, and then added to it.
+# With a NeighborhoodDiagnostics collector, every fit (but not the models taken from the cache) is recorded in it.
+# Returns the [degree, coefficients] of every neighborhood, in order.
+def fit_neighborhoods(neighborhoods, training, args, pool=None, cache=None, diagnostics=None):
+    if cache is not None:
+        keys = cache.keys(neighborhoods)
+        models = cache.get(keys)
+        to_fit = [nbhd for nbhd, key in enumerate(keys) if key not in models]
+        fitted = fit_neighborhoods(neighborhoods[to_fit], training, args, pool, diagnostics=diagnostics)
+        cache.put([(keys[nbhd], model) for nbhd, model in zip(to_fit, fitted)])
+        models.update(zip([keys[nbhd] for nbhd in to_fit], fitted))
+        return [models[key] for key in keys]
+    
+    if pool is not None:
+        return fit_neighborhoods_in_pool(neighborhoods, pool, args, diagnostics)
+    return fit_neighborhood_rows(neighborhoods, training.indep, training.dep, args, diagnostics)
+
+
+# The KNN fast path: the local model of a KNN neighborhood is just the mean of the dependent variable over it (degree 0),
+#  so the means of all the neighborhoods (an array with one row of training indices each) are computed in one vectorized step,
+#  rather than fitting a model for each of them.
+# With a NeighborhoodDiagnostics collector, the means are recorded in it as fits of degree 0.
+# Returns the mean of every neighborhood (with a column for each dependent variable, if there are several).
+def neighborhood_means(neighborhoods, dep, diagnostics=None):
+    t0 = time()
+    means = np.mean(dep[neighborhoods], axis=1)
+    if diagnostics is not None:
+        diagnostics.record_means(neighborhoods.shape[1], means, (time() - t0)/max(1, means.size))
+    count("models.fit", len(neighborhoods))
+    count("solver.mean", means.size)
+    return means
+
+
+# The output rows (as from evaluate_neighborhood) of points at xy whose predictions are the given means of the KNN fast path.
+def mean_output(xy, means, args):
+    targets = len(dep_columns(args))
+    output = np.zeros((len(xy), 2 + 2*targets))
+    output[:, :2] = xy
+    output[:, 2:2 + targets] = np.clip(np.reshape(means, (len(xy), targets)), args.lowerBound, args.upperBound)
+    return output
+
+
+# The serial pipeline for a block of evaluation points (rows of an array formatted like input2 of main):
+#  shift the points, sort them into neighborhoods, fit the model of each neighborhood, and evaluate it.
+# With a pool from worker_pool, the models are fit by the pool.
+# With recent_models, an OrderedDict, models of neighborhoods seen in earlier blocks are reused,
+#  and at most args.keepModels of the most recently used models are kept in it for later blocks.
+# With a LocalModelCache, models are also reused from (and saved for) other runs.
+# With a NeighborhoodDiagnostics collector, the fits are recorded in it.
+# With a profile dictionary, the seconds spent in each stage (XtP, NoP, DoN, MiN, and EoN) 
+#  and the number of points and neighborhoods are added to it.
+# This returns the (m, 4) array of x, y, prediction, and degree for the block, grouped by neighborhood
+#  (with several dependent variables, the predictions of all of them, then the degrees of all of them).
+def predict_points(input2, training, args, pool=None, recent_models=None, cache=None, diagnostics=None, profile=None):
+    Independent_Data, Dependent_Data, index, shift, scale, columns = training
+    t = time()
+    
+    # First stage: shift points.
+    # Points with the same (shifted) covariates have the same neighborhood and prediction,
+    #  so only the distinct ones (unique_Ps) go through the rest of the pipeline.
+    xy = input2[:, :2]
+    Ps = ((input2[:, columns] - shift)*scale)**args.Flatten
+    unique_Ps, unique_of_point = unique_rows(Ps)
+    log(f"The {len(Ps)} evaluation points have {len(unique_Ps)} distinct covariate vectors.\n", file=args.logFile)
+    t = lap(profile, "XtP", t)
+    
+    # Second stage: find the neighbors of the points, and sort the points into their neighborhoods.
+    neighborhoods, nbhd_of_unique = find_neighborhoods(index, unique_Ps, args.k, norm=args.norm)
+    nbhd_of_point = nbhd_of_unique[unique_of_point]
+    num_distinct = len(neighborhoods)
+    log(f"The {len(Ps)} evaluation points fall in {num_distinct} distinct neighborhoods.\n", file=args.logFile)
+    t = lap(profile, "NoP", t)
+    
+    # With args.shareJaccard, only the representative neighborhoods get models, which the points of similar neighborhoods share.
+    if args.shareJaccard:
+        exact_neighborhoods, exact_of_point = neighborhoods, nbhd_of_point
+        rep_of = share_neighborhoods(exact_neighborhoods, args.shareJaccard)
+        is_rep = rep_of == np.arange(len(rep_of))
+        neighborhoods = exact_neighborhoods[is_rep]
+        nbhd_of_unique = (np.cumsum(is_rep, dtype=np.int32) - 1)[rep_of[nbhd_of_unique]]
+        nbhd_of_point = nbhd_of_unique[unique_of_point]
+        log(f"Sharing neighborhoods with a Jaccard index of at least {args.shareJaccard}, {len(neighborhoods)} local models "
+            f"will be fit instead of {num_distinct} ({100*(1 - len(neighborhoods)/max(1, num_distinct)):.1f}% fewer).\n", file=args.logFile)
+    order, starts = group_by_neighborhood(nbhd_of_point, len(neighborhoods))
+    if METRICS is not None:
+        METRICS.count("points", len(Ps))
+        METRICS.count("points.distinct", len(unique_Ps))
+        METRICS.count("neighborhoods.distinct", num_distinct)
+        METRICS.count("neighborhoods.modeled", len(neighborhoods))
+        METRICS.histogram("points_per_neighborhood", np.diff(starts))
+    add_to_profile(profile, "points", len(Ps))
+    add_to_profile(profile, "neighborhoods", len(neighborhoods))
+    t = lap(profile, "DoN", t)
+    
+    # Third stage: compute the coefficients for each neighborhood (that hasn't recently been modeled).
+    # KNN models are just means, which are all computed at once and are cheaper to recompute than to reuse or cache.
+    if args.model == "KNN":
+        means = neighborhood_means(neighborhoods, training.dep, diagnostics)
+    elif recent_models is None:
+        stored_coefs = fit_neighborhoods(neighborhoods, training, args, pool, cache, diagnostics)
+    else:
+        keys = [N.tobytes() for N in neighborhoods]
+        to_fit = [nbhd for nbhd, key in enumerate(keys) if key not in recent_models]
+        log(f"Reusing {len(keys) - len(to_fit)} recently fit local models.\n", file=args.logFile)
+        for nbhd, model in zip(to_fit, fit_neighborhoods(neighborhoods[to_fit], training, args, pool, cache, diagnostics)):
+            recent_models[keys[nbhd]] = model
+        stored_coefs = []
+        for key in keys:
+            recent_models.move_to_end(key)
+            stored_coefs.append(recent_models[key])
+        while len(recent_models) > args.keepModels:
+            recent_models.popitem(last=False)
+    t = lap(profile, "MiN", t)
+    
+    # Fourth stage: evaluate the model of each neighborhood on every point in that neighborhood
+    #  (once for each distinct point), writing the predictions of the points, grouped by neighborhood, into a single array.
+    if args.model == "KNN":
+        output = mean_output(xy[order], means[nbhd_of_point[order]], args)
+    else:
+        output = evaluate_neighborhoods(stored_coefs, unique_Ps, nbhd_of_unique, xy[order], unique_of_point[order], args)
+    lap(profile, "EoN", t)
+    
+    if args.shareJaccard and args.shareCheck:
+        targets = len(dep_columns(args))
+        predictions = np.empty((len(Ps), targets))
+        predictions[order] = output[:, 2:2 + targets]
+        check_shared_predictions(exact_neighborhoods, rep_of, exact_of_point, Ps, predictions, training, args, pool)
+    
+    return output
+
+
+# Add amount to the named entry of a profile dictionary (as taken by predict_points), unless profile is None.
+def add_to_profile(profile, name, amount):
+    if profile is not None:
+        profile[name] = profile.get(name, 0) + amount
+
+
+# Add the seconds since start to the named stage of a profile dictionary; returns the current time.
+def lap(profile, stage, start):
+    now = time()
+    add_to_profile(profile, stage, now - start)
+    return now
+
+
+# Evaluate a local model (M = [degree, coefficients]) at the shifted points (Ps) of its neighborhood,
+#  clipped to the bounds in args.
+# With several dependent variables, M is the list of the models of each of them.
+# Returns the array with rows of x, y, prediction, and degree, given the (x, y) coordinates of the points
+#  (or x, y, the predictions of every dependent variable, and then their degrees).
+def evaluate_neighborhood(M, xy, Ps, args):
+    models = M if len(dep_columns(args)) > 1 else [M]
+    output = np.empty((len(Ps), 2 + 2*len(models)))
+    output[:, :2] = xy
+    for target, (degree, coefs) in enumerate(models):
+        output[:, 2 + target] = np.clip(evaluate_polynomial_batch(coefs, degree, Ps, basis_of(args)), args.lowerBound, args.upperBound)
+        output[:, 2 + len(models) + target] = degree
+    return output
+
+
+# Evaluate the model of every neighborhood (models, by neighborhood ID) at each of the distinct points unique_Ps once,
+#  given the neighborhood ID of each of them (nbhd_of_unique).
+# Returns the output rows (as from evaluate_neighborhood) of the points at xy, 
+#  given the index in unique_Ps of the covariates of each of them (unique_of_point).
+def evaluate_neighborhoods(models, unique_Ps, nbhd_of_unique, xy, unique_of_point, args):
+    unique_order, unique_starts = group_by_neighborhood(nbhd_of_unique, len(models))
+    unique_output = np.empty((len(unique_Ps), 2 + 2*len(dep_columns(args))))
+    for nbhd, model in enumerate(models):
+        points = unique_order[unique_starts[nbhd]:unique_starts[nbhd + 1]]
+        unique_output[points] = evaluate_neighborhood(model, 0, unique_Ps[points], args)
+    output = unique_output[unique_of_point]
+    output[:, :2] = xy
+    return output
+
+
+# Open the sink for the predictions (rows of x, y, prediction, and degree) in the given format (by default args.out_format).
+# With several dependent variables, the columns are x, y, z<i> for each dependent column index i, and then degree<i> for each.
+# Text output keeps the full precision of the predictions; the binary formats store them as float32.
+def open_output(path, args, out_format=None):
+    targets = dep_columns(args)
+    names = [""] if len(targets) == 1 else targets
+    return open_sink(path, out_format or args.out_format, 
+                     columns=["x", "y"] + [f"z{i}" for i in names] + [f"degree{i}" for i in names], fmt='%.15f',
+                     dtypes=[np.float64, np.float64] + [np.float32]*len(targets) + [np.int8]*len(targets))
+
+
+# Run the pipeline on the evaluation data (input2) with Spark, writing the predictions to args.out.
+# The training data and its neighbor index are broadcast to the executors once.
+# The points are grouped into their neighborhoods by appending to lists in place.
+# Each partition writes its predictions to its own part file, and the part files are then concatenated into args.out
+#  (text parts directly, or .npy parts streamed into the sink of the output format),
+#  so the predictions never pass through the driver's memory all at once.
+# With a NeighborhoodDiagnostics collector, the rows recorded by every partition are sent back and added to it.
+# Returns the number of predictions written.
+def predict_with_spark(input2, training, args, diagnostics=None):
+    init_parallel()
+    sc = SC.getOrCreate()
+    # Broadcast a plain tuple, since the executors can't unpickle classes defined in this script.
+    shared = sc.broadcast(tuple(training))
+    
+    # XtP and NoP: shift all the points (X) of a partition and find their neighborhoods in one batch (once per distinct point).
+    # Each neighborhood is keyed by the bytes of its sorted int32 array of training indices.
+    # With args.shareJaccard, the points are keyed by the representative of their neighborhood within the partition.
+    def NoP(Xs):
+        Xs = np.array(list(Xs), dtype=float)
+        if not len(Xs):
+            return
+        indep, dep, index, shift, scale, columns = shared.value
+        Ps = ((Xs[:, columns] - shift)*scale)**args.Flatten
+        unique_Ps, unique_of_point = unique_rows(Ps)
+        neighborhoods, nbhd_of_unique = find_neighborhoods(index, unique_Ps, args.k, norm=args.norm)
+        nbhd_of_point = nbhd_of_unique[unique_of_point]
+        if args.shareJaccard:
+            nbhd_of_point = share_neighborhoods(neighborhoods, args.shareJaccard)[nbhd_of_point]
+        keys = [N.tobytes() for N in neighborhoods]
+        for nbhd, X, P in zip(nbhd_of_point, Xs, Ps):
+            yield keys[nbhd], (X[:2], P)
+    
+    # Grow the first list, rather than copying both into a new one.
+    def append(xyPs, xyP):
+        xyPs.append(xyP)
+        return xyPs
+    def extend(xyPs, more_xyPs):
+        xyPs.extend(more_xyPs)
+        return xyPs
+    
+    # DoN, MiN and EoN: gather the data of each neighborhood (N) of a partition, find its model, 
+    #  and evaluate the model at the points of the neighborhood.
+    # The neighborhoods of a partition are taken args.fitBatch at a time, to be fit together (see fit_neighborhood_rows).
+    def MiN(groups, partition_diagnostics):
+        indep, dep = shared.value[:2]
+        groups = iter(groups)
+        while True:
+            batch = list(islice(groups, max(1, args.fitBatch)))
+            if not batch:
+                break
+            for key, xyPs in batch:
+                count("points", len(xyPs))
+                count("neighborhoods.modeled")
+                if METRICS is not None:
+                    METRICS.histogram("points_per_neighborhood", [len(xyPs)])
+            neighborhoods = np.array([np.frombuffer(key, dtype=np.int32) for key, xyPs in batch])
+            for (key, xyPs), M in zip(batch, fit_neighborhood_rows(neighborhoods, indep, dep, args, partition_diagnostics)):
+                yield evaluate_neighborhood(M, [xyP[0] for xyP in xyPs], [xyP[1] for xyP in xyPs], args)
+    
+    part_format = "csv" if args.out_format == "csv" else "npy"
+    def write_partition(partition, groups):
+        part_path = f"{args.out}.part-{partition:05d}"
+        partition_diagnostics = open_diagnostics(args)
+        with open_output(part_path, args, part_format) as part, task_metrics(args) as partition_metrics:
+            for output in MiN(groups, partition_diagnostics):
+                part.write(output)
+        rows = partition_diagnostics.rows() if partition_diagnostics is not None else None
+        yield (partition, part_path, part.count, rows, partition_metrics.as_dict() if partition_metrics is not None else None)
+    
+    # KNN needs no shuffle of the points into their neighborhoods: 
+    #  each partition predicts all its points with the means of their neighborhoods at once (see neighborhood_means).
+    def write_knn_partition(partition, Xs):
+        Xs = np.array(list(Xs), dtype=float)
+        part_path = f"{args.out}.part-{partition:05d}"
+        partition_diagnostics = open_diagnostics(args)
+        with open_output(part_path, args, part_format) as part, task_metrics(args) as partition_metrics:
+            if len(Xs):
+                indep, dep, index, shift, scale, columns = shared.value
+                Ps = ((Xs[:, columns] - shift)*scale)**args.Flatten
+                unique_Ps, unique_of_point = unique_rows(Ps)
+                neighborhoods, nbhd_of_unique = find_neighborhoods(index, unique_Ps, args.k, norm=args.norm)
+                nbhd_of_point = nbhd_of_unique[unique_of_point]
+                count("points", len(Xs))
+                count("neighborhoods.modeled", len(neighborhoods))
+                if METRICS is not None:
+                    METRICS.histogram("points_per_neighborhood", np.bincount(nbhd_of_point))
+                part.write(mean_output(Xs[:, :2], neighborhood_means(neighborhoods, dep, partition_diagnostics)[nbhd_of_point], args))
+        rows = partition_diagnostics.rows() if partition_diagnostics is not None else None
+        yield (partition, part_path, part.count, rows, partition_metrics.as_dict() if partition_metrics is not None else None)
+    
+    rdd = sc.parallelize(input2)
+    if args.model == "KNN":
+        rdd = rdd.mapPartitionsWithIndex(write_knn_partition)
+    else:
+        rdd = rdd.mapPartitions(NoP)
+        rdd = rdd.aggregateByKey([], append, extend)
+        rdd = rdd.mapPartitionsWithIndex(write_partition)
+    parts = sorted(rdd.collect(), key=lambda part: part[0])
+    sc.stop()
+    for partition, part_path, part_count, rows, metrics in parts:
+        if diagnostics is not None:
+            diagnostics.extend(rows)
+        merge_metrics(metrics)
+    
+    if part_format == "csv":
+        with open(args.out, "wb") as out_file:
+            for partition, part_path, part_count, rows, metrics in parts:
+                with open(part_path, "rb") as part_file:
+                    shutil.copyfileobj(part_file, out_file)
+                os.remove(part_path)
+    else:
+        with open_output(args.out, args) as sink:
+            for partition, part_path, part_count, rows, metrics in parts:
+                part = np.load(part_path, mmap_mode="r")
+                for start in range(0, len(part), 2**20):
+                    sink.write(structured_to_unstructured(part[start:start + 2**20], dtype=float))
+                del part
+                os.remove(part_path)
+    return sum(part_count for partition, part_path, part_count, rows, metrics in parts)
+
+
+# A fitted HyppoModel holds everything that is prepared from the training data once:
+#  the shift and scale, the transformed training data, and the nearest-neighbor index,
+#  so that any number of batches (e.g., tiles) of evaluation points can then be predicted without redoing any of it.
+# args is a Namespace of the arguments of this script (e.g., from model_args); it is copied, and the copy is finalized by fit.
+# Local models are reused by later batches that share neighborhoods, keeping at most args.keepModels of them.
+# The model can be pickled (without its reusable local models) to load it in other processes.
+# Example:
+#   model = HyppoModel(model_args(model="HYPPO", k=20, degree=2, skipVars=2)).fit(train_array)
+#   for tile in tiles:
+#       predictions = model.predict(tile)[:, 2]
+class HyppoModel:
+    def __init__(self, args):
+        self.settings = copy(args)
+        self.args = None
+        self.training = None
+        self.recent_models = OrderedDict()
+
+    # input1 is the training data, formatted like input1 of main.
+    # eval_minimum is the minimum of every column of all the evaluation data, which is only needed with args.Flatten.
+    def fit(self, input1, eval_minimum=None):
+        if self.settings.Flatten and eval_minimum is None:
+            raise ValueError("Flattening (Flatten) requires the minimum of every column of the evaluation data (eval_minimum).")
+        self.args = copy(self.settings)
+        self.training = prepare_training(np.asarray(input1, dtype=float), self.args, eval_minimum)
+        self.recent_models = OrderedDict()
+        return self
+
+    # Predict a batch of evaluation points (formatted like input2 of main).
+    # pool, cache, diagnostics, and profile are as in predict_points.
+    # Returns the array of x, y, prediction, and degree (see predict_points), grouped by neighborhood.
+    def predict(self, input2, pool=None, cache=None, diagnostics=None, profile=None):
+        if self.training is None:
+            raise ValueError("The HyppoModel must be fit before it can predict.")
+        input2 = np.atleast_2d(np.asarray(input2, dtype=float))
+        return predict_points(input2, self.training, self.args, pool=pool, recent_models=self.recent_models, 
+                              cache=cache, diagnostics=diagnostics, profile=profile)
+
+    # A worker_pool over the training data if args.parallel is 2, or a null context otherwise.
+    def pool(self):
+        if self.args.parallel == 2:
+            return worker_pool(self.training.indep, self.training.dep, self.args)
+        return nullcontext()
+
+    # The persistent cache of local models for this training data (see open_model_cache).
+    def cache(self):
+        return open_model_cache(self.training, self.args)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["recent_models"] = OrderedDict()
+        return state
+
+
+# The Namespace of the arguments of this script, with the defaults of get_parser, for building a HyppoModel in Python.
+# params are any arguments (by their long names) to change from the defaults, e.g., model_args(model="KNN", k=5, degree=0).
+def model_args(**params):
+    args = get_parser().parse_args(["--train", "", "--eval", ""])
+    unknown = set(params) - set(vars(args))
+    if unknown:
+        raise TypeError(f"Unknown hyppo arguments: {', '.join(sorted(unknown))}.")
+    vars(args).update(params)
+    return args
+
+
+# input1 and input2 are arrays or ndarrays.
+# Columns index 0 and 1 of input1 and input2 are the x/y-coordinates.
+# input1 should have 1 more column than input2, the column with the dependent variable (or 1 more for each of several).
+# depIndex is the index of the dependent variable column in input1 (or a comma-separated list of several).
+# model is one of ["HYPPO", "KNN", "SBM"].
+# Implementations of HYPPO and SBM are not well-suited for high dimensional data,
+#  unless the basis of the local polynomials is limited (args.interactions and args.crossDegree; see Basis).
+# k is the number of nearest neighbors for HYPPO or KNN (is overridden for SBM).
+# This returns the array of predictions, except with Spark (-p1), which writes them to args.out and returns None.
+# If args.out isn't set, it is set to the default output name.
+# With a profile dictionary, the seconds of each stage and the number of points and neighborhoods are added to it 
+#  (see predict_points), except with Spark.
+def main(input1, input2, args, profile=None):
+    
+    model = HyppoModel(args).fit(input1, eval_minimum=np.amin(input2, axis=0) if args.Flatten else None)
+    if not args.out:
+        args.out = default_output_name(model.args)
+    diagnostics = open_diagnostics(args)
+    if reset_metrics(args) is not None and profile is None:
+        profile = {}
     
     t0 = time()
             
-    # Run the above operations on the eval data, in parallel if directed to; ...
-    if args.parallel:   
-        init_parallel()
-        sc = SC.getOrCreate()
-        rdd = sc.parallelize(input2)
-        rdd = rdd.map(XtP)
-        
-        rdd = rdd.map(lambda xyP: (NoP(xyP[1]), [xyP]))
-        rdd = rdd.reduceByKey(lambda a, b: a + b)
-        
-        rdd = rdd.map(lambda NP: (DoN(NP[0]), NP[1]))
-        rdd = rdd.map(lambda DP: (MiN(DP[0]), DP[1]))
-        
-        rdd = rdd.map(lambda MP: EoN(*MP))
-        
-        output = rdd.reduce(lambda a, b: a + b)
-        sc.stop()
+    # Run the pipeline on the eval data, in parallel with Spark if directed to 
+    #  (in which case the predictions are written straight to args.out); ...
+    if args.parallel == 1:   
+        model.args.out = args.out
+        written = predict_with_spark(input2, model.training, model.args, diagnostics)
+        log(f"{written} predictions have been written to {args.out}.\n", file=args.logFile)
+        output = None
             
-    # ... otherwise, do it in serial.        
+    # ... otherwise, find the neighborhoods in serial, and fit them in serial or with a process pool.        
     else:
-        # First stage: shift points.
-        xyPs = [XtP(X) for X in input2]
-        
-        # Second stage: sort the points into their neighborhoods.
-        stored_nbrs = {}
-        for xyP in xyPs:
-            nbrs = NoP(xyP[1])
-            if nbrs in stored_nbrs:
-                stored_nbrs[nbrs].append(xyP)
-            else:
-                stored_nbrs[nbrs] = [xyP]
-        
-        #sampleN = list(stored_nbrs.keys())[0]
-        #print(sampleN)
-        #print(stored_nbrs[sampleN])
-        
-        # Third stage: compute the coefficients for each neighborhood.
-        stored_nbrdata = {N: DoN(N) for N in stored_nbrs}
-        #print(stored_nbrdata[sampleN])
-        stored_coefs = {N: MiN(stored_nbrdata[N]) for N in stored_nbrs}
-        #print(stored_coefs[sampleN])
-        
-        # Fourth stage: evaluate the model of each neighborhood on every point in that neighborhood.
-        stored_evaluations = {N: EoN(stored_coefs[N], stored_nbrs[N]) for N in stored_nbrs}
-        #print(stored_evaluations[sampleN])
-        
-        # Finally, flatten all the predictions into a single array.
-        output = [xyzd for N in stored_evaluations for xyzd in stored_evaluations[N]]
+        with model.pool() as pool, model.cache() as cache:
+            output = model.predict(input2, pool=pool, cache=cache, diagnostics=diagnostics, profile=profile)
+        if cache is not None:
+            log(f"{cache.summary()}\n", file=args.logFile)
         
     log(f"It took {time() - t0} seconds to perform model_at_point on all the evaluation points.\n", file=args.logFile)
 
     # Execute optional data dumps.
-    if args.errorFile:
-        with open(args.errorFile, "w") as error_dump:
-            for errors in stored_errors.values():
-                error_dump.write(",".join([str(err) for err in errors]) + "\n")
+    write_diagnostics(diagnostics, args)
+    write_metrics(profile or {}, args)
     
     return output
 
+
+# Streaming version of main, for evaluation data too large to hold in memory.
+# eval_chunks is an iterable of arrays (formatted like input2 of main), e.g. from read_chunks,
+#  and eval_minimum is the minimum of every column of all the evaluation data, which is only needed with args.Flatten.
+# Each chunk is sorted into neighborhoods and predicted, and the predictions are written to args.out right away.
+# Models are reused for neighborhoods seen in recent chunks, so memory stays bounded by the chunk size and args.keepModels.
+def main_streaming(input1, eval_chunks, args, eval_minimum=None):
+    if args.parallel == 1:
+        raise ValueError("Streaming evaluation (--chunkSize) is not available with Spark (-p1).")
+    
+    model = HyppoModel(args).fit(input1, eval_minimum=eval_minimum)
+    if not args.out:
+        args.out = default_output_name(model.args)
+    
+    diagnostics = open_diagnostics(args)
+    profile = {} if reset_metrics(args) is not None else None
+    t0 = time()
+    evaluated = 0
+    with open_output(args.out, args) as sink, model.pool() as pool, model.cache() as cache:
+        for chunk in eval_chunks:
+            output = model.predict(chunk, pool=pool, cache=cache, diagnostics=diagnostics, profile=profile)
+            sink.write(output)
+            evaluated += len(chunk)
+            log(f"{evaluated} evaluation points have been predicted after {time() - t0} seconds.\n", file=args.logFile)
+    if cache is not None:
+        log(f"{cache.summary()}\n", file=args.logFile)
+    
+    log(f"It took {time() - t0} seconds to perform model_at_point on all the evaluation points.\n", file=args.logFile)
+    write_diagnostics(diagnostics, args)
+    write_metrics(profile or {}, args)
+
+
+# Read a delimited text file in chunks of up to chunk_size rows, after skipping the header rows.
+# Yields each chunk as a 2-D array.
+def read_chunks(path, chunk_size, delimiter=",", skiprows=1):
+    with open(path) as in_file:
+        for _ in range(skiprows):
+            next(in_file, None)
+        while True:
+            lines = list(islice(in_file, chunk_size))
+            if not lines:
+                return
+            yield np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+
+
+# Fit the models of a neighborhood for every maximum degree in degrees at once, for a parameter sweep:
+#  the cross-validation errors of every degree up to the largest are computed once, 
+#  each maximum degree selects the best degree up to it from those, and the model of each selected degree is fit once.
+# Returns the model (as from model_in_neighborhood) for each of the degrees, in order.
+def sweep_models_in_neighborhood(selected_indep_data, selected_dep_data, args, degrees):
+    sweep_args = copy(args)
+    sweep_args.degree = max(degrees)
+    Total_SSE, rand_coef_log = crossvalidation_errors(selected_indep_data, selected_dep_data, sweep_args)
+    several = np.ndim(selected_dep_data) > 1
+    fitted = {}
+    models = []
+    for D in degrees:
+        selection = select_degree(Total_SSE, rand_coef_log, D)
+        chosen = tuple(target[0] for target in selection) if several else selection[0]
+        if chosen not in fitted:
+            model = fit_selected_degree(selected_indep_data, selected_dep_data, selection, args)
+            count("models.fit")
+            fitted[chosen] = [[degree, coefficients] for degree, errors, coefficients in (model if several else [model])]
+        models.append(fitted[chosen] if several else fitted[chosen][0])
+    return models
+
+
+# sweep_models_in_neighborhood for a batch of neighborhoods of the same size (an array with one row of training indices each) at once:
+#  they are cross-validated together for the largest of degrees (see batch_crossvalidation_errors), 
+#  each maximum degree selects the best degree up to it from those errors, 
+#  and the models of all the selected degrees are fit together, once each (see fit_degrees).
+# Returns the models of every degree for every neighborhood, as from sweep_models_in_neighborhood.
+def sweep_models_in_neighborhoods(neighborhoods, indep, dep, args, degrees):
+    sweep_args = copy(args)
+    sweep_args.degree = max(degrees)
+    B, n = neighborhoods.shape
+    X = np.asarray(indep[neighborhoods], dtype=float)
+    Z = np.asarray(dep[neighborhoods], dtype=float).reshape(B, n, -1)
+    Total_SSE, rand_coef_log = batch_crossvalidation_errors(X, Z, sweep_args)
+    # The (len(degrees), B, R) winning degrees of every maximum degree, neighborhood, and target.
+    winning_degrees = np.array([np.argmin(Total_SSE[:D + 1], axis=0) for D in degrees])
+    
+    A = design_matrix(X.reshape(B*n, -1), sweep_args.degree, basis_of(args)).reshape(B, n, -1)
+    selected = np.any(np.arange(sweep_args.degree + 1)[:, None, None, None] == winning_degrees, axis=1)
+    coefficients = fit_degrees(A, Z, X.shape[2], selected, rand_coef_log, sweep_args)
+    
+    several = np.ndim(dep) > 1
+    models = []
+    for b in range(B):
+        chosen = [tuple(winners) for winners in winning_degrees[:, b].tolist()]
+        count("models.fit", len(set(chosen)))
+        targets = [[[degree, coefficients[degree, b, target]] for target, degree in enumerate(winners)] for winners in chosen]
+        models.append([winners if several else winners[0] for winners in targets])
+    return models
+
+
+# Fit the models of neighborhoods (an array with one row of training indices each) in this process for every maximum degree 
+#  in degrees: in batches with sweep_models_in_neighborhoods, where it applies (see neighborhood_batches), 
+#  or one at a time with sweep_models_in_neighborhood otherwise.
+def sweep_neighborhood_rows(neighborhoods, indep, dep, args, degrees):
+    batches = neighborhood_batches(neighborhoods, indep, dep, max(degrees), args)
+    if batches is None:
+        return [sweep_models_in_neighborhood(indep[N], dep[N], args, degrees) for N in neighborhoods]
+    return [models for batch in batches for models in sweep_models_in_neighborhoods(batch, indep, dep, args, degrees)]
+
+
+# Fit the models of all the neighborhoods for every maximum degree in degrees (see sweep_neighborhood_rows),
+#  with the pool from worker_pool if one is given, or in serial otherwise.
+# Returns the list of the models of every degree for every neighborhood, in order.
+def sweep_neighborhoods(neighborhoods, training, args, degrees, pool=None):
+    if pool is None:
+        return sweep_neighborhood_rows(neighborhoods, training.indep, training.dep, args, degrees)
+    chunks = [chunk for chunk in np.array_split(neighborhoods, 4*pool_size(args)) if len(chunk)]
+    fitted = pool.map(sweep_neighborhoods_in_worker, [(chunk, args.k, degrees) for chunk in chunks], chunksize=1)
+    for models, metrics in fitted:
+        merge_metrics(metrics)
+    return [model for models, metrics in fitted for model in models]
+
+
+# The values of a parameter to sweep, from a comma-separated list (e.g., args.sweepK), or just default if it is empty.
+def sweep_values(text, default):
+    return [int(value) for value in text.split(",")] if text else [default]
+
+
+# The output path of the predictions with k and D in a parameter sweep: 
+#  args.out with _k-<k>_D-<D> before its extension, or the default output name with k and D if args.out isn't set.
+def sweep_output_name(args, k, D):
+    if args.out:
+        root, extension = os.path.splitext(args.out)
+        return f"{root}_k-{k}_D-{D}{extension}"
+    combination = copy(args)
+    combination.k, combination.degree = k, D
+    return default_output_name(combination)
+
+
+# Parameter sweep: predict input2 (as main does) with every combination of the k values in args.sweepK
+#  and the maximum degrees in args.sweepD (comma-separated lists, each defaulting to just args.k or args.degree),
+#  and write the predictions of each combination to its own output (see sweep_output_name).
+# Rather than running each combination from scratch, the training data is prepared once, 
+#  the neighbors of every distinct evaluation point are found once for the largest k 
+#  (the k nearest of them are the first k, as they are sorted by distance), 
+#  and for each k, every neighborhood is cross-validated once for the largest degree (see sweep_models_in_neighborhood).
+# KNN ignores the degrees, and SBM ignores the values of k, as they do in main.
+# This returns the list of (k, D, path) of the outputs written.
+def sweep(input1, input2, args):
+    if args.parallel == 1:
+        raise ValueError("A parameter sweep (--sweepK/--sweepD) is not available with Spark (-p1).")
+    if open_diagnostics(args) is not None:
+        raise ValueError("The diagnostic outputs (-E, -C, --diagnosticsFile) are not available with a parameter sweep.")
+    if args.chunkSize or args.shareJaccard or args.cacheDir:
+        raise ValueError("Streaming (--chunkSize), neighborhood sharing (--shareJaccard), and the model cache (--cacheDir) are not available with a parameter sweep.")
+    ks = sweep_values(args.sweepK, args.k)
+    degrees = [0] if args.model == "KNN" else sweep_values(args.sweepD, args.degree)
+    
+    settings = copy(args)
+    settings.k, settings.degree = max(ks), max(degrees)
+    model = HyppoModel(settings).fit(input1, eval_minimum=np.amin(input2, axis=0) if args.Flatten else None)
+    training = model.training
+    if args.model == "SBM":
+        ks = [model.args.k]
+    reset_metrics(args)
+    t0 = time()
+    
+    xy = input2[:, :2]
+    Ps = ((input2[:, training.columns] - training.shift)*training.scale)**model.args.Flatten
+    unique_Ps, unique_of_point = unique_rows(Ps)
+    searched = [k for k in ks if k < len(training.dep) - 1]
+    if searched:
+        neighbors = batch_indices_of_NNs(training.index, unique_Ps, max(searched), norm=args.norm)
+    
+    written = []
+    with model.pool() as pool:
+        for k in ks:
+            k_args = copy(model.args)
+            k_args.k = k
+            if k in searched:
+                table = NeighborhoodTable(k)
+                nbhd_of_unique = table.add(neighbors[:, :k])
+                neighborhoods = table.neighborhoods()
+            else:
+                neighborhoods, nbhd_of_unique = find_neighborhoods(training.index, unique_Ps, k, norm=args.norm)
+            nbhd_of_point = nbhd_of_unique[unique_of_point]
+            order, starts = group_by_neighborhood(nbhd_of_point, len(neighborhoods))
+            log(f"With k={k}, the {len(Ps)} evaluation points fall in {len(neighborhoods)} distinct neighborhoods.\n", file=args.logFile)
+            
+            if args.model == "KNN":
+                outputs = [mean_output(xy[order], neighborhood_means(neighborhoods, training.dep)[nbhd_of_point[order]], k_args)]
+            else:
+                models = sweep_neighborhoods(neighborhoods, training, k_args, degrees, pool)
+                outputs = [evaluate_neighborhoods([nbhd_models[d] for nbhd_models in models], unique_Ps, nbhd_of_unique, 
+                                                  xy[order], unique_of_point[order], k_args) for d in range(len(degrees))]
+            
+            for D, output in zip(degrees, outputs):
+                path = sweep_output_name(k_args, k, D)
+                with open_output(path, k_args) as sink:
+                    sink.write(output)
+                written.append((k, D, path))
+                log(f"The predictions with k={k} and D={D} have been written to {path} after {time() - t0} seconds.\n", file=args.logFile)
+    
+    write_metrics({}, args)
+    return written
+
+
+# If the output filename isn't specified, 
+#  the name will be generated by the arguments, separated by _, 
+#  with a double (__) between the data arguements and the model parameters.
+def default_output_name(args):
+    basis = f"_I-{args.interactions}_C-{args.crossDegree}" if any(basis_of(args)) else ""
+    return f"{args.train.split('/')[-1]}_e-{args.eval.split('/')[-1]}_i-{args.depIndex}_s-{args.skipVars}_v-{args.variables}_m-{args.model}_k-{args.k}_D-{args.degree}_L-{args.Lasso}_R-{args.randIters}{basis}.{args.out_format}"
+
+
 def get_parser():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--train", required=True,
@@ -576,8 +2043,8 @@ def get_parser():
                         help="Name of file where the evaluation points are stored (required).")
     parser.add_argument("-o", "--out", 
                         help="Name of file where prediction is to be stored.")
-    parser.add_argument("-i", "--depIndex", type=int, default=2, 
-                        help="Index of column in train file with dependent variable to be tested for building a model (default: %(default)s).")
+    parser.add_argument("-i", "--depIndex", default="2", 
+                        help="Index of column in train file with dependent variable to be tested for building a model (default: %(default)s). A comma-separated list of indices (e.g., 2,3,4) fits all of them on the same neighborhoods, with a prediction and a degree column for each in the output. Several don't work with --cacheDir.")
     parser.add_argument("-r", "--headerRows", type=int, default=1, 
                         help="Number of rows to ignore, being header row(s) (default: %(default)s).")
     parser.add_argument("-d", "--delimiter", default=",", 
@@ -592,10 +2059,16 @@ def get_parser():
                         help="Specify the scale to multiply your independent variables by; for example -s0 -v2 -S1,2. Uses reciprocals of standard deviations if unspecified.")
     parser.add_argument("-N", "--norm", type=int, default=2, 
                         help="Specify N for l_N norm; default is 2 (Euclidean). This is used for identifying the nearest neighbors.")
-    parser.add_argument("-p", "--parallel", type=int, default=0, 
-                        help="1 to run in parallel with Spark; 0 otherwise (default).")
+    parser.add_argument("-p", "--parallel", type=int, choices=[0, 1, 2], default=0, 
+                        help="1 to run in parallel with Spark; 2 to fit the local models with a pool of local processes; 0 otherwise (default).")
+    parser.add_argument("-w", "--workers", type=int, default=0, 
+                        help="Number of worker processes for -p2 (default: %(default)s, uses all available cores).")
     parser.add_argument("-L", "--Lasso", type=float, default=0, 
                         help="Specify whether to use the Lasso value to limit the number of monomial in the local polynomial models (default: %(default)s).")
+    parser.add_argument("--interactions", type=int, default=0, 
+                        help="The most covariates that one term of the local polynomials may combine, e.g., 2 for only pairwise interactions, or 1 for only the powers of each covariate; this keeps the number of terms tractable with many covariates. 0 for no limit (default).")
+    parser.add_argument("--crossDegree", type=int, default=0, 
+                        help="The highest degree of a term that combines several covariates, e.g., 2 for the powers of each covariate up to -D plus only the products of pairs of covariates. 0 for no limit (default).")
     parser.add_argument("-F", "--Flatten", type=float, default=0, 
                         help="Allow for sublinear models and lower degree by raising all predictors to a power p<1. Shifts predictors to 0-centered if 0; shifts predictors to strictly positive otherwise.")
     parser.add_argument("-b", "--lowerBound", type=float, default=0, 
@@ -605,11 +2078,39 @@ def get_parser():
     parser.add_argument("-l", "--logFile", default="", 
                         help="The path for a log file; will print instead of logging if empty string (default).")
     parser.add_argument("-E", "--errorFile", default="", 
-                        help="The path for error data; will throw away if empty string (default). Doesn't work with -p1.")
+                        help="The path for the cross-validation SSE of each degree, one line per local model; will throw away if empty string (default).")
     parser.add_argument("-C", "--degreeCountFile", default="", 
-                        help="The path for the number of coefficients of each degree; will not compute if empty string (default).")
+                        help="The path for the number of coefficients of each degree, one line per local model; will not compute if empty string (default).")
+    parser.add_argument("--diagnosticsFile", default="", 
+                        help="The path for a .npy structured array with the neighborhood size, degree, cross-validation SSE and term count of each degree, and fit time of every local model; will not compute if empty string (default).")
     parser.add_argument("-R", "--randIters", type=int, default="0", 
                         help="When the number of terms in the polynomial needs to be decreased, just randomly select terms; this specifies how many random combinations of terms to try (default: %(default)s).")
+    parser.add_argument("--out-format", choices=FORMATS, default="csv", 
+                        help="The format of the output: csv (default) is text with full precision; npy, parquet, feather, and tif (GeoTIFF) are binary with float32 predictions.")
+    parser.add_argument("--float32", action="store_true", 
+                        help="Share the preprocessed training data with the worker processes of -p2 in single precision, which halves that shared memory; the neighbor index and the other modes keep double precision, and the local models are still fit in double precision.")
+    parser.add_argument("--fitBatch", type=int, default=1024, 
+                        help="The number of neighborhoods whose local models are cross-validated and fit together with batched linear algebra (default: %(default)s); 0 fits them one at a time. Random term selection (-R without -L) always fits them one at a time.")
+    parser.add_argument("--chunkSize", type=int, default=0, 
+                        help="Stream the evaluation file in chunks of this many rows, appending predictions to the output as they are made; 0 (default) loads the whole file at once. Doesn't work with -p1.")
+    parser.add_argument("--metricsFile", default="", 
+                        help="The path for a JSON file of counters, stage times, and histograms of the run (e.g., how often each solver branch runs, and the points per neighborhood); will not compute if empty string (default).")
+    parser.add_argument("--shareJaccard", type=float, default=0, 
+                        help="Approximate: evaluation points whose neighborhoods overlap a fit neighborhood with at least this Jaccard index (in (0, 1]) share its local model, so fewer models are fit; 0 (default) fits every distinct neighborhood exactly.")
+    parser.add_argument("--shareCheck", type=int, default=0, 
+                        help="With --shareJaccard, also fit exact models for a sample of this many points with shared models, and log how much their predictions change (default: %(default)s). Doesn't work with -p1.")
+    parser.add_argument("--keepModels", type=int, default=2**16, 
+                        help="With --chunkSize, the number of recently fit local models to keep for reuse in later chunks (default: %(default)s).")
+    parser.add_argument("--sweepK", default="", 
+                        help="A comma-separated list of values of k (e.g., 10,20,40) to sweep over, writing the predictions of each combination with --sweepD to its own output (_k-<k>_D-<D> is added to -o); the neighbor search is shared by all of them. No sweep if empty string (default). Doesn't work with -p1, the diagnostic outputs, --chunkSize, --shareJaccard, or --cacheDir.")
+    parser.add_argument("--sweepD", default="", 
+                        help="A comma-separated list of maximum degrees (e.g., 1,2,3) to sweep over, as with --sweepK; the cross-validation of each neighborhood is shared by all of them. No sweep if empty string (default).")
+    parser.add_argument("--cacheDir", default="", 
+                        help="Directory of a persistent cache of fit local models, reused by later runs with the same training data and model arguments; no cache if empty string (default). Doesn't work with -p1.")
+    parser.add_argument("--cacheMaxMB", type=float, default=1024, 
+                        help="Evict the least recently used local models once the cache is larger than this many megabytes; 0 for no limit (default: %(default)s).")
+    parser.add_argument("--cacheMaxDays", type=float, default=30, 
+                        help="Evict local models that haven't been used for this many days; 0 for no limit (default: %(default)s).")
     return parser
 
 
@@ -629,17 +2130,34 @@ if __name__ == "__main__":
     # ./hypppo6.py -t train.csv -e eval.csv -v3 -D4 -k9 -L1 -Edump.err -Hdump.nbr -Cdump.deg
 
     # Read in the training data and evaluation data and save to numpy dataframes
-    original_values = np.loadtxt(args.train, delimiter=args.delimiter, skiprows=args.headerRows)
+    original_values = np.loadtxt(args.train, delimiter=args.delimiter, skiprows=args.headerRows, ndmin=2)
     log(f"\n{len(original_values)} lines of original data have been loaded from {args.train}.\n", file=args.logFile)
-    values_to_model = np.loadtxt(args.eval, delimiter=args.delimiter, skiprows=args.headerRows)
-    log(f"{len(values_to_model)} lines of evaluation data have been loaded from {args.eval}.\n", file=args.logFile)
+    
+    # Run a parameter sweep, if directed to.
+    if args.sweepK or args.sweepD:
+        values_to_model = np.loadtxt(args.eval, delimiter=args.delimiter, skiprows=args.headerRows, ndmin=2)
+        log(f"{len(values_to_model)} lines of evaluation data have been loaded from {args.eval}.\n", file=args.logFile)
+        sweep(original_values, values_to_model, args)
+    
+    # Stream the evaluation data in chunks, if directed to.
+    elif args.chunkSize:
+        eval_minimum = None
+        if args.Flatten:
+            # The shift for flattening depends on the minima of the evaluation data, so take one pass to find them.
+            chunk_minima = [np.amin(chunk, axis=0) for chunk in read_chunks(args.eval, args.chunkSize, args.delimiter, args.headerRows)]
+            eval_minimum = np.amin(chunk_minima, axis=0)
+        log(f"Evaluation data will be streamed from {args.eval} in chunks of {args.chunkSize} lines.\n", file=args.logFile)
+        main_streaming(original_values, read_chunks(args.eval, args.chunkSize, args.delimiter, args.headerRows), args, eval_minimum)
+    
+    else:
+        values_to_model = np.loadtxt(args.eval, delimiter=args.delimiter, skiprows=args.headerRows, ndmin=2)
+        log(f"{len(values_to_model)} lines of evaluation data have been loaded from {args.eval}.\n", file=args.logFile)
 
-    output = main(original_values, values_to_model, args)
+        output = main(original_values, values_to_model, args)
 
-    # If the output filename isn't specified, 
-    #  the name will be generated by the arguments, separated by _, 
-    #  with a double (__) between the data arguements and the model parameters.
-    if not args.out:
-        args.out=f"{args.train.split('/')[-1]}_e-{args.eval.split('/')[-1]}_i-{args.depIndex}_s-{args.skipVars}_v-{args.variables}_m-{args.model}_k-{args.k}_D-{args.degree}_L-{args.Lasso}_R-{args.randIters}.csv"
+        if output is not None:
+            if not args.out:
+                args.out = default_output_name(args)
 
-    np.savetxt(args.out, output, delimiter=",", fmt='%.15f')
+            with open_output(args.out, args) as sink:
+                sink.write(output)
@@ -16,6 +16,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.metrics import mean_squared_error
+from prediction_sink import FORMATS, open_sink
 
 
 #Input arguments to execute the k-Nearest Neighbors Regression 
@@ -27,6 +28,7 @@ def get_parser():
     parser.add_argument('-seed', "--seed", help='Seed for reproducibility purposed in random research grid', default=3)
     parser.add_argument('-e', "--evaluationdata", help='Evaluation data')
     parser.add_argument('-o', "--outputdata", help='Predictions')
+    parser.add_argument("--out-format", help='Format of the predictions: csv (default), npy, parquet, feather, or tif (GeoTIFF)', choices=FORMATS, default="csv")
     parser.add_argument('-l', "--log", help='Log file')
     parser.add_argument("-f", "--fff", help="a dummy argument to fool ipython", default="1")
     return parser 
@@ -117,16 +119,16 @@ def preprocess_evaluationdata (evaluation_data, ss):
     
     return(x_predict)
 
-def predict_knn(x_predict, evaluation_data, output_data, knn):
+def predict_knn(x_predict, evaluation_data, output_data, knn, out_format="csv"):
     # Load knn regressor
     #knn = pickle.load(open(pathtomodel+'model.pkl', 'rb'))
     # Predict on evaluation data
     y_predict = knn.predict(x_predict)
-    # Create dataframe with long, lat, soil moisture
-    out_df = pd.DataFrame(data={'x':evaluation_data['x'].round(decimals=9), 'y':evaluation_data['y'].round(decimals=9), 'sm':y_predict})
-    out_df = out_df.reindex(['x','y','sm'], axis=1)
-    #Print to file predictions 
-    out_df.to_csv(output_data, index=False, header=False)
+    # Stack long, lat, soil moisture
+    out = np.column_stack([evaluation_data['x'].round(decimals=9), evaluation_data['y'].round(decimals=9), y_predict])
+    # Print to file predictions (text output is formatted like pandas' to_csv)
+    with open_sink(output_data, out_format, columns=['x','y','sm'], fmt='%s') as sink:
+        sink.write(out)
 
 
 if __name__ == "__main__":	
@@ -137,4 +139,4 @@ if __name__ == "__main__":
     knn = train_knn(x_train, y_train, maxK, seed, ss)
     validate_knn(knn, x_test, y_test)
     x_predict = preprocess_evaluationdata (evaluation_data, ss)
-    predict_knn(x_predict, evaluation_data, output_data, knn)
+    predict_knn(x_predict, evaluation_data, output_data, knn, args.out_format)
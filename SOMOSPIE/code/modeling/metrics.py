@@ -0,0 +1,63 @@
+# Counters, timers, and histograms of the hot paths of hyppo.py, written as JSON at the end of a run.
+# The metrics of worker processes (a process pool or Spark executors) are sent back with their results
+#  as the dictionary from as_dict, and merged into the metrics of the main process.
+
+import json
+import numpy as np
+
+
+class Metrics:
+    def __init__(self):
+        self.counters = {}
+        self.seconds = {}
+        self.histograms = {}
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def time(self, name, seconds):
+        self.seconds[name] = self.seconds.get(name, 0) + seconds
+
+    # Add non-negative integer values to a histogram, kept as the count of every value.
+    def histogram(self, name, values):
+        tallies = np.bincount(np.asarray(values, dtype=np.intp))
+        previous = self.histograms.get(name)
+        if previous is not None:
+            if len(previous) > len(tallies):
+                previous, tallies = tallies, previous
+            tallies[:len(previous)] += previous
+        self.histograms[name] = tallies
+
+    def as_dict(self):
+        return {"counters": dict(self.counters), "seconds": dict(self.seconds),
+                "histograms": {name: tallies.tolist() for name, tallies in self.histograms.items()}}
+
+    # Add the metrics of another Metrics, given as its as_dict.
+    def merge(self, other):
+        for name, amount in other["counters"].items():
+            self.count(name, amount)
+        for name, seconds in other["seconds"].items():
+            self.time(name, seconds)
+        for name, tallies in other["histograms"].items():
+            self.histogram(name, np.repeat(np.arange(len(tallies)), tallies))
+
+    # Write the metrics as JSON, with a summary (count, mean, and percentiles) of every histogram.
+    def write(self, path):
+        report = self.as_dict()
+        report["summaries"] = {name: summarize_histogram(tallies) for name, tallies in self.histograms.items()}
+        with open(path, "w") as metrics_file:
+            json.dump(report, metrics_file, indent=2, sort_keys=True)
+            metrics_file.write("\n")
+
+
+# The count, mean, min, max, and 50th, 90th, and 99th percentiles of the values tallied in a histogram.
+def summarize_histogram(tallies):
+    total = int(np.sum(tallies))
+    if not total:
+        return {"count": 0}
+    values = np.arange(len(tallies))
+    cumulative = np.cumsum(tallies)
+    percentile = lambda q: int(values[np.searchsorted(cumulative, q*total)])
+    return {"count": total, "mean": float(np.dot(values, tallies)/total),
+            "min": int(values[np.flatnonzero(tallies)[0]]), "max": int(len(tallies) - 1),
+            "p50": percentile(0.5), "p90": percentile(0.9), "p99": percentile(0.99)}
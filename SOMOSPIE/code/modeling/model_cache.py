@@ -0,0 +1,85 @@
+# Persistent cache of the local models fit by hyppo.py, so that repeated runs
+#  (e.g., the same training file against different evaluation tiles) don't refit the same neighborhoods.
+# The models are stored in a single SQLite file in the cache directory.
+
+import hashlib, pathlib, sqlite3
+import numpy as np
+from time import time
+
+
+# Local models are keyed on a digest of the context (everything that determines a model except the neighborhood)
+#  together with the neighborhood's sorted array of training indices.
+# max_megabytes and max_days bound the size of the cache and the age of its entries; 0 for no bound.
+class LocalModelCache:
+    def __init__(self, directory, context, max_megabytes=0, max_days=0):
+        self.path = pathlib.Path(directory).joinpath("local_models.sqlite")
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.context = context
+        self.max_bytes = max_megabytes*2**20
+        self.max_age = max_days*24*3600
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("""CREATE TABLE IF NOT EXISTS models (
+                                   key BLOB PRIMARY KEY, degree INTEGER, coefs BLOB, size INTEGER, last_used REAL)""")
+        self.connection.commit()
+
+    # The keys of the neighborhoods (an array with one row of training indices each).
+    def keys(self, neighborhoods):
+        return [hashlib.blake2b(self.context + np.ascontiguousarray(N).tobytes(), digest_size=20).digest()
+                for N in neighborhoods]
+
+    # Look up the given keys; returns a dictionary from the keys found to their [degree, coefficients].
+    def get(self, keys):
+        found = {}
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            rows = self.connection.execute(f"SELECT key, degree, coefs FROM models WHERE key IN ({','.join('?'*len(batch))})",
+                                           batch).fetchall()
+            for key, degree, coefs in rows:
+                found[key] = [degree, list(np.frombuffer(coefs))]
+
+        now = time()
+        self.connection.executemany("UPDATE models SET last_used=? WHERE key=?", [(now, key) for key in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    # Store models, given pairs of keys and [degree, coefficients].
+    def put(self, items):
+        now = time()
+        rows = []
+        for key, (degree, coefs) in items:
+            coefs = np.asarray(coefs, dtype=float).tobytes()
+            rows.append((key, int(degree), coefs, len(key) + len(coefs), now))
+        self.connection.executemany("INSERT OR REPLACE INTO models VALUES (?, ?, ?, ?, ?)", rows)
+        self.connection.commit()
+
+    # Drop entries unused for longer than the max age, then the least recently used entries beyond the max size.
+    def evict(self):
+        before = self.connection.total_changes
+        if self.max_age:
+            self.connection.execute("DELETE FROM models WHERE last_used < ?", (time() - self.max_age,))
+        if self.max_bytes:
+            self.connection.execute("""DELETE FROM models WHERE key IN (
+                                       SELECT key FROM (SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS total FROM models)
+                                       WHERE total > ?)""", (self.max_bytes,))
+        self.connection.commit()
+        self.evicted += self.connection.total_changes - before
+
+    def close(self):
+        self.evict()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def summary(self):
+        lookups = self.hits + self.misses
+        rate = self.hits/lookups if lookups else 0
+        return f"Local model cache {self.path}: {self.hits} hits, {self.misses} misses ({100*rate:.1f}% hit rate), {self.evicted} evicted."
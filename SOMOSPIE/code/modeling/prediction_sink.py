@@ -0,0 +1,187 @@
+# Output of model predictions, shared by hyppo.py, knn.py, and rf.py.
+# Every sink takes blocks of prediction rows (x, y, prediction, ...) as they are made,
+#  so the predictions never have to be held in memory all at once (except for GeoTIFF, which needs the full grid).
+# Coordinates are kept as float64, and every other column is stored as float32 unless specified otherwise.
+#
+# Formats:
+#   csv       delimited text, as the models have always written (default)
+#   npy       NumPy structured array, one field per column
+#   parquet   Apache Parquet (requires pyarrow)
+#   feather   Feather v2 / Arrow IPC (requires pyarrow)
+#   tif       GeoTIFF with one band per prediction column, on the grid of the x/y coordinates (requires GDAL)
+
+import os, shutil
+import numpy as np
+
+FORMATS = ["csv", "npy", "parquet", "feather", "tif"]
+
+
+# Open the sink for the given format; columns are the names of the columns of the rows to be written.
+# fmt is the printf-style format (or list of formats) of the values in csv.
+# dtypes are the dtypes of the columns in the binary formats; by default float64 for x/y and float32 for the rest.
+# crs is the coordinate reference system of x/y, for tif.
+def open_sink(path, out_format="csv", columns=("x", "y", "sm"), fmt="%.15f", dtypes=None, crs="EPSG:4326"):
+    if dtypes is None:
+        dtypes = [np.float64]*2 + [np.float32]*(len(columns) - 2)
+    if out_format == "csv":
+        return CSVSink(path, columns, fmt)
+    elif out_format == "npy":
+        return NpySink(path, columns, dtypes)
+    elif out_format == "parquet":
+        return ParquetSink(path, columns, dtypes)
+    elif out_format == "feather":
+        return FeatherSink(path, columns, dtypes)
+    elif out_format == "tif":
+        return GeoTIFFSink(path, columns, dtypes, crs)
+    else:
+        raise ValueError(f"\"{out_format}\" is not a valid output format; choose from {FORMATS}.")
+
+
+# Base class of the sinks; subclasses implement write_block and finish.
+class PredictionSink:
+    def __init__(self, path, columns):
+        self.path = str(path)
+        self.columns = list(columns)
+        self.count = 0
+
+    # Write a 2-D array (or anything that converts to one) with one row per prediction.
+    def write(self, rows):
+        rows = np.asarray(rows, dtype=float).reshape(-1, len(self.columns))
+        if len(rows):
+            self.write_block(rows)
+            self.count += len(rows)
+
+    def close(self):
+        self.finish()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CSVSink(PredictionSink):
+    def __init__(self, path, columns, fmt="%.15f"):
+        super().__init__(path, columns)
+        self.fmt = fmt
+        self.file = open(self.path, "w")
+
+    def write_block(self, rows):
+        np.savetxt(self.file, rows, delimiter=",", fmt=self.fmt)
+        self.file.flush()
+
+    def finish(self):
+        self.file.close()
+
+
+# The rows are appended to a temporary file of raw records,
+#  and the .npy header (which needs the final row count) is written in front of them when the sink is closed.
+class NpySink(PredictionSink):
+    def __init__(self, path, columns, dtypes):
+        super().__init__(path, columns)
+        self.dtype = np.dtype(list(zip(self.columns, dtypes)))
+        self.raw_path = self.path + ".raw"
+        self.raw_file = open(self.raw_path, "wb")
+
+    def write_block(self, rows):
+        records = np.empty(len(rows), dtype=self.dtype)
+        for j, name in enumerate(self.columns):
+            records[name] = rows[:, j]
+        self.raw_file.write(records.tobytes())
+
+    def finish(self):
+        self.raw_file.close()
+        header = {"descr": np.lib.format.dtype_to_descr(self.dtype), "fortran_order": False, "shape": (self.count,)}
+        with open(self.path, "wb") as npy_file, open(self.raw_path, "rb") as raw_file:
+            np.lib.format.write_array_header_2_0(npy_file, header)
+            shutil.copyfileobj(raw_file, npy_file)
+        os.remove(self.raw_path)
+
+
+# Parquet and Feather are written one record batch per block with pyarrow.
+class ArrowSink(PredictionSink):
+    def __init__(self, path, columns, dtypes):
+        super().__init__(path, columns)
+        try:
+            import pyarrow
+        except ImportError:
+            raise ImportError(f"Writing {type(self).__name__[:-4]} output requires pyarrow (conda install pyarrow).")
+        self.pa = pyarrow
+        self.dtypes = dtypes
+        self.schema = pyarrow.schema([(name, pyarrow.from_numpy_dtype(np.dtype(dtype))) for name, dtype in zip(self.columns, dtypes)])
+        self.writer = self.open_writer()
+
+    def write_block(self, rows):
+        arrays = [self.pa.array(rows[:, j].astype(dtype)) for j, dtype in enumerate(self.dtypes)]
+        self.writer.write_batch(self.pa.record_batch(arrays, schema=self.schema))
+
+    def finish(self):
+        self.writer.close()
+
+
+class ParquetSink(ArrowSink):
+    def open_writer(self):
+        import pyarrow.parquet
+        return pyarrow.parquet.ParquetWriter(self.path, self.schema)
+
+
+class FeatherSink(ArrowSink):
+    def open_writer(self):
+        import pyarrow.ipc
+        return pyarrow.ipc.new_file(self.path, self.schema)
+
+
+# The raster grid is inferred from the coordinates of all the predictions:
+#  the resolution is the smallest spacing between distinct x (or y) values,
+#  and x/y are taken to be cell centers, as in the csv files made from rasters.
+# Cells without a prediction are NaN (nodata).
+class GeoTIFFSink(PredictionSink):
+    def __init__(self, path, columns, dtypes, crs="EPSG:4326"):
+        super().__init__(path, columns)
+        try:
+            from osgeo import gdal, osr
+        except ImportError:
+            raise ImportError("Writing GeoTIFF output requires GDAL (conda install -c conda-forge gdal).")
+        self.gdal, self.osr = gdal, osr
+        self.crs = crs
+        self.blocks = []
+
+    def write_block(self, rows):
+        self.blocks.append(np.array(rows[:, :2]))
+        self.blocks.append(rows[:, 2:].astype(np.float32))
+
+    @staticmethod
+    def resolution(values):
+        steps = np.diff(np.unique(values))
+        steps = steps[steps > 1e-9*max(1, np.max(np.abs(values)))]
+        return np.min(steps) if len(steps) else 1.0
+
+    def finish(self):
+        if not self.count:
+            return
+        xy = np.concatenate(self.blocks[0::2])
+        values = np.concatenate(self.blocks[1::2])
+        self.blocks = []
+
+        dx, dy = self.resolution(xy[:, 0]), self.resolution(xy[:, 1])
+        xmin, ymax = np.min(xy[:, 0]), np.max(xy[:, 1])
+        cols = np.rint((xy[:, 0] - xmin)/dx).astype(np.intp)
+        rows = np.rint((ymax - xy[:, 1])/dy).astype(np.intp)
+
+        gdal = self.gdal
+        raster = gdal.GetDriverByName("GTiff").Create(self.path, int(cols.max()) + 1, int(rows.max()) + 1, values.shape[1],
+                                                       gdal.GDT_Float32, options=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=YES'])
+        raster.SetGeoTransform((xmin - dx/2, dx, 0, ymax + dy/2, 0, -dy))
+        srs = self.osr.SpatialReference()
+        srs.SetFromUserInput(self.crs)
+        raster.SetProjection(srs.ExportToWkt())
+        for b, name in enumerate(self.columns[2:]):
+            grid = np.full((raster.RasterYSize, raster.RasterXSize), np.nan, dtype=np.float32)
+            grid[rows, cols] = values[:, b]
+            band = raster.GetRasterBand(b + 1)
+            band.SetDescription(name)
+            band.SetNoDataValue(np.nan)
+            band.WriteArray(grid)
+        raster.FlushCache()
+        raster = None  # closes file
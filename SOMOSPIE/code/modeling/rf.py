@@ -17,6 +17,7 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import StandardScaler
 from sklearn.model_selection import RandomizedSearchCV
 from sklearn.metrics import mean_squared_error
+from prediction_sink import FORMATS, open_sink
 
 def get_parser():
     #Input arguments to execute the k-Nearest Neighbors Regression 
@@ -24,6 +25,7 @@ def get_parser():
     parser.add_argument('-t', "--trainingdata", help='Training data')
     parser.add_argument('-e', "--evaluationdata", help='Evaluation data')
     parser.add_argument('-o', "--outputdata", help='Predictions')
+    parser.add_argument("--out-format", help='Format of the predictions: csv (default), npy, parquet, feather, or tif (GeoTIFF)', choices=FORMATS, default="csv")
     parser.add_argument('-l', "--log", help='Log file')
     parser.add_argument('-maxtree', "--maxtree", help='Maximum number of trees to try for finding optimal model', default=2000)
     parser.add_argument('-seed', "--seed", help='Seed for reproducibility purposed in random research grid', default=3)
@@ -117,14 +119,14 @@ def preprocess_evaluationdata (evaluation_data,ss):
     
     return(x_predict)
 
-def predict_rf(x_predict, evaluation_data, output_data, rf):
+def predict_rf(x_predict, evaluation_data, output_data, rf, out_format="csv"):
     # Predict on evaluation data
     y_predict = rf.predict(x_predict)
-    # Create dataframe with long, lat, soil moisture
-    out_df = pd.DataFrame(data={'x':evaluation_data['x'].round(decimals=9), 'y':evaluation_data['y'].round(decimals=9), 'sm':y_predict})
-    out_df = out_df.reindex(['x','y','sm'], axis=1)
-    # Print to file predictions 
-    out_df.to_csv(output_data, index=False, header=False)
+    # Stack long, lat, soil moisture
+    out = np.column_stack([evaluation_data['x'].round(decimals=9), evaluation_data['y'].round(decimals=9), y_predict])
+    # Print to file predictions (text output is formatted like pandas' to_csv)
+    with open_sink(output_data, out_format, columns=['x','y','sm'], fmt='%s') as sink:
+        sink.write(out)
 
 if __name__ == "__main__":
     parser=get_parser()
@@ -134,4 +136,4 @@ if __name__ == "__main__":
     rf = train_rf(x_train, y_train, maxtree, seed)
     validate_rf(rf, x_test, y_test)
     x_predict = preprocess_evaluationdata (evaluation_data, ss)
-    predict_rf(x_predict, evaluation_data, output_data, rf)
+    predict_rf(x_predict, evaluation_data, output_data, rf, args.out_format)
@@ -3,6 +3,7 @@ from os import listdir
 from utils import *
 from itertools import product as iterprod
 from time import time
+from glob import glob
 
 
 # This is a wrapper that handles a single call to any of the models
@@ -35,6 +36,30 @@ from time import time
 #         the third column is the sm data,
 #         all other columns are covariates
 
+# The parameters of hyppo.py that it can sweep over in a single call (with --sweepK and --sweepD), by model.
+# SBM uses all the training data as neighbors, so only its degree is swept.
+SWEEPS = {"HYPPO": {"-k": "--sweepK", "-D": "--sweepD"}, 
+          "SBM": {"-D": "--sweepD"}}
+# The hyppo.py options that don't work with a sweep; combinations that set any of them are run one at a time.
+NO_SWEEP = ["-E", "-C", "--diagnosticsFile", "--chunkSize", "--shareJaccard", "--cacheDir"]
+
+
+# Group the parameter combinations of MODEL (as in suffixes[MODEL]) that hyppo.py can run in a single sweep: 
+#  those that differ only in the swept parameters.
+# Returns a list of (the other parameters, their file suffix, and a list of the (bash suffix, file suffix) of the combinations),
+#  for the groups with more than one combination.
+def sweep_groups(MODEL, suffixes):
+    swept = SWEEPS.get(MODEL, {})
+    groups = {}
+    for bash_suf, file_suf in suffixes:
+        fixed = tuple((par, arg) for par, arg in bash_suf if par not in swept)
+        if any(par in NO_SWEEP or (par == "-p" and str(arg) == "1") for par, arg in fixed):
+            continue
+        groups.setdefault(fixed, []).append((bash_suf, file_suf))
+    return [(list(fixed), "".join([f"{par}{arg}" for par, arg in fixed]), combos) 
+            for fixed, combos in groups.items() if len(combos) > 1]
+
+
 def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE):
 
     HYPPO_MODEL = pathlib.Path("modeling/hyppo.py").resolve()
@@ -90,7 +115,58 @@ def model(REGION, TRAIN_DIR, EVAL_DIR, OUT_DIR, MODELS, NOTE):
             #        file_name += f"{p}{a}"
             #        bash_suffix.extend([p, a])
      
+            # Run the combinations that differ only in k and D as one parameter sweep of hyppo.py,
+            #  which finds the neighbors and cross-validates each neighborhood once for all of them,
+            #  and move each prediction to the file it would have had from a run of its own.
+            swept_sufs = []
+            for fixed, fixed_suf, combos in sweep_groups(MODEL, suffixes[MODEL]):
+                
+                t0 = time()
+                
+                # Specify paths of output files; hyppo.py adds _k-<k>_D-<D> to the prediction file of every combination.
+                file_name = MODEL + fixed_suf + "_sweep"
+                PRD = PRED.joinpath(f"{file_name}.csv")
+                LOG = PRED.joinpath(f"{file_name}.log")
+                
+                bash_args = [HYPPO_MODEL, "-t", TR, "-e", EV, "-m", MODEL, "-o", PRD, "-l", LOG]
+                for par, sweep_flag in SWEEPS[MODEL].items():
+                    values = sorted(set(str(arg) for bash_suf, _ in combos for p, arg in bash_suf if p == par))
+                    if values:
+                        bash_args.extend([sweep_flag, ",".join(values)])
+                for bashix in fixed:
+                    bash_args.extend(bashix)
+                with open(LOG, "w") as log:
+                    log.write(f"t0={t0}\n")
+                    log.write(f"{REGION} {MODEL}\n")
+                    log.write(f"bash_args: {bash_args}\n")
+                bash(bash_args)
+                
+                t1 = time()
+                with open(LOG, "a") as log:
+                    log.write(f"t1={t1}\n")
+                    log.write(f"t={t1 - t0}\n")
+                
+                # k or D is hyppo.py's own (or, with SBM, all the training data) when it isn't among the parameters.
+                # Every combination gets its own log, as from a run of its own, with the time of the whole sweep.
+                for bash_suf, file_suf in combos:
+                    values = dict(bash_suf)
+                    pattern = f"{file_name}_k-{values.get('-k', '*')}_D-{values.get('-D', '*')}.csv"
+                    for path in glob(str(PRED.joinpath(pattern))):
+                        pathlib.Path(path).replace(PRED.joinpath(f"{MODEL}{file_suf}.csv"))
+                    with open(PRED.joinpath(f"{MODEL}{file_suf}.log"), "w") as log:
+                        log.write(f"t0={t0}\n")
+                        log.write(f"Prediction file: {PRED.joinpath(f'{MODEL}{file_suf}.csv')}\n")
+                        log.write(f"Log file: {PRED.joinpath(f'{MODEL}{file_suf}.log')}\n")
+                        log.write(f"{REGION} {MODEL}\n")
+                        log.write(f"bash_suffix: {bash_suf}\n")
+                        log.write(f"Swept together with {len(combos) - 1} other combinations; see {LOG}\n")
+                        log.write(f"t1={t1}\n")
+                        log.write(f"t={t1 - t0}\n")
+                    swept_sufs.append(file_suf)
+            
             for bash_suf, file_suf in suffixes[MODEL]:
+                if file_suf in swept_sufs:
+                    continue
                 
                 t0 = time()
                 